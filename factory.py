@@ -3,19 +3,35 @@
 import sys
 import os
 import pty
+import tty
+import termios
 from time import time, sleep
 import json
 import random
 from pathlib import Path
 import socket
 import shutil
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 import subprocess
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 from argparse import ArgumentParser, REMAINDER
 import shlex
 import logging
 import signal
+import asyncio
+import select
+import selectors
+import threading
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import zlib
+import queue
+import fcntl
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+import hashlib
+from functools import lru_cache
 
 """
 reference:
@@ -52,12 +68,79 @@ class Paths:
         self.datadir = datadir
         self.IMAGES = datadir / 'images'
         self.VAR = datadir / 'var'
+        self.LAYERS = datadir / 'layers'
+        self.BLOBS = datadir / 'blobs'
+        self.SOCKET = self.VAR / 'factory.sock'
         self.IMAGES.mkdir(parents=True, exist_ok=True)
 
 
 paths = Paths(Path.home() / '.factory')
 
 
+class Tracer:
+    """
+    Times the phases of a run. With `--trace FILE`, every phase is written as
+    a Chrome trace "complete" event, one per line, so the file loads in
+    `chrome://tracing` and can also be read line by line. Totals per phase
+    are logged at the end of the run with `-v`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.totals = defaultdict(lambda: [0, 0.0])
+
+    def open(self, path):
+        self.file = open(path, 'w', encoding='utf8')
+        # the trace format allows leaving out the closing bracket
+        self.file.write('[\n')
+
+    @contextmanager
+    def phase(self, name, **args):
+        t0 = time()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self.record(name, t0, time() - t0, args)
+
+    def record(self, name, start, duration, args):
+        with self.lock:
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += duration
+
+            if self.file is not None:
+                event = {
+                    'name': name,
+                    'ph': 'X',
+                    'ts': int(start * 1e6),
+                    'dur': int(duration * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                }
+                if args:
+                    event['args'] = args
+                self.file.write(json.dumps(event) + ',\n')
+                self.file.flush()
+
+    def finish(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+            totals = sorted(self.totals.items(), key=lambda i: -i[1][1])
+            for (name, (count, total)) in totals:
+                logger.debug("%9.3fs %4dx %s", total, count, name)
+            self.totals.clear()
+
+
+tracer = Tracer()
+
+
 def get_arch():
     return subprocess.check_output(['uname', '-m']).decode('latin1').strip()
 
@@ -65,24 +148,289 @@ def echo_run(cmd):
     logger.debug('+ ' + ' '.join(cmd))
     subprocess.run(cmd, check=True)
 
-@contextmanager
-def cd(path):
-    prev = os.getcwd()
-    os.chdir(str(path))
-    try:
-        yield
-    finally:
-        os.chdir(prev)
-
-
-def open_qmp(qmp_path):
-    qmp = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+def open_socket(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        qmp.connect(qmp_path)
+        sock.connect(path)
     except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
         return None
     else:
-        return qmp
+        return sock
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf8') + b'\n')
+
+
+def read_message(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf8'))
+
+
+class QMPError(RuntimeError):
+    pass
+
+
+class QMPClient:
+    """
+    Asynchronous QMP client. Command replies are matched by id, and
+    asynchronous events are queued until someone waits for them. A single
+    event loop can drive clients for many VMs.
+    """
+
+    def __init__(self):
+        self.next_id = 0
+        self.pending = {}
+        self.events = None
+        self.writer = None
+
+    async def connect(self, path):
+        (reader, self.writer) = await asyncio.open_unix_connection(path)
+        self.events = asyncio.Queue()
+        greeting = json.loads((await reader.readline()).decode('utf8'))
+        self.version = greeting['QMP']['version']
+        self.read_task = asyncio.ensure_future(self.read_loop(reader))
+        await self.execute('qmp_capabilities')
+
+    async def read_loop(self, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                # qemu exits right after some commands, e.g. `quit`
+                break
+            if not line:
+                break
+
+            message = json.loads(line.decode('utf8'))
+            if 'event' in message:
+                self.events.put_nowait(message)
+                continue
+
+            future = self.pending.pop(message.get('id'), None)
+            if future is None or future.done():
+                continue
+            if 'error' in message:
+                future.set_exception(QMPError(message['error']['desc']))
+            else:
+                future.set_result(message.get('return'))
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(QMPError("QMP connection closed"))
+        self.pending.clear()
+        self.events.put_nowait(None)
+
+    async def execute(self, name, **arguments):
+        if self.read_task.done():
+            raise QMPError("QMP connection closed")
+        self.next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.next_id] = future
+        command = {'execute': name, 'arguments': arguments, 'id': self.next_id}
+        self.writer.write(json.dumps(command).encode('utf8') + b'\n')
+        return await future
+
+    async def wait_event(self, names, timeout=None):
+        """
+        Wait for one of the events in `names`; other events are dropped.
+        Returns `None` if the connection is closed first, e.g. because qemu
+        has exited.
+        """
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time()
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            event = await asyncio.wait_for(self.events.get(), remaining)
+            if event is None:
+                self.events.put_nowait(None)
+                return None
+            if event['event'] in names:
+                return event
+            logger.debug("QMP event: %s", event['event'])
+
+    async def close(self):
+        self.writer.close()
+        await self.read_task
+
+
+class QMP:
+    """
+    Synchronous wrapper that runs a `QMPClient` on a private event loop, so
+    every VM can be driven from its own thread.
+    """
+
+    def __init__(self, path):
+        self.loop = asyncio.new_event_loop()
+        self.client = QMPClient()
+        self.run(self.client.connect(path))
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def execute(self, name, **arguments):
+        return self.run(self.client.execute(name, **arguments))
+
+    def wait_event(self, names, timeout=None):
+        return self.run(self.client.wait_event(names, timeout))
+
+    def close(self):
+        try:
+            self.run(self.client.close())
+        finally:
+            self.loop.close()
+
+
+CONSOLE_LOG_SIZE = 256 << 10
+CONSOLE_TAIL_SIZE = 16 << 10
+# older `failed-boot-*.log` files in `var` are removed
+FAILED_BOOT_LOGS = 20
+
+
+class ConsoleLog:
+    """
+    Records a VM's serial console to `path`, keeping at most `max_size`
+    bytes on disk: when the file reaches half of that, it's renamed with a
+    `.1` suffix and a new one is started. Listeners get a copy of the
+    output as it arrives.
+    """
+
+    def __init__(self, path, sock, max_size=CONSOLE_LOG_SIZE):
+        self.path = path
+        self.old_path = path.with_name(path.name + '.1')
+        self.sock = sock
+        self.max_size = max_size
+        self.file = path.open('wb')
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def received(self, data):
+        half = self.max_size // 2
+        with self.lock:
+            if self.file.tell() + len(data) > half:
+                self.file.close()
+                self.path.rename(self.old_path)
+                self.file = self.path.open('wb')
+            self.file.write(data[-half:])
+            self.file.flush()
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener(data)
+
+    def tail(self, size=CONSOLE_TAIL_SIZE):
+        with self.lock:
+            data = b''
+            for path in [self.old_path, self.path]:
+                if path.exists():
+                    data += path.read_bytes()
+        return data[-size:]
+
+    def send(self, data):
+        # the socket is non-blocking because `console_reader` reads from it
+        while data:
+            try:
+                data = data[self.sock.send(data):]
+            except BlockingIOError:
+                select.select([], [self.sock], [])
+
+    def close(self):
+        console_reader.unregister(self)
+        self.sock.close()
+        with self.lock:
+            self.file.close()
+
+
+class ConsoleReader:
+    """
+    Reads the serial consoles of all the VMs in this process on a single
+    background thread, so a VM costs no extra process or thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selector = None
+
+    def register(self, log):
+        with self.lock:
+            if self.selector is None:
+                self.selector = selectors.DefaultSelector()
+                (self.wakeup, wakeup_reader) = socket.socketpair()
+                self.selector.register(wakeup_reader, selectors.EVENT_READ)
+                threading.Thread(target=self.run, daemon=True).start()
+
+            log.sock.setblocking(False)
+            self.selector.register(log.sock, selectors.EVENT_READ, log)
+            self.wakeup.send(b'.')
+
+    def unregister(self, log):
+        with self.lock:
+            if self.selector is None:
+                return
+            try:
+                self.selector.unregister(log.sock)
+            except (KeyError, ValueError):
+                pass
+            self.wakeup.send(b'.')
+
+    def run(self):
+        while True:
+            for (key, _) in self.selector.select():
+                if key.data is None:
+                    key.fileobj.recv(1024)
+                    continue
+
+                try:
+                    data = key.fileobj.recv(1 << 16)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+
+                if not data:
+                    # qemu has exited
+                    self.unregister(key.data)
+                    continue
+
+                key.data.received(data)
+
+
+console_reader = ConsoleReader()
+
+
+def load_json(path):
+    """ Read a JSON file, or return `None` if it doesn't exist. """
+    if not path.is_file():
+        return None
+    with path.open(encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    """ Write a JSON file atomically, by renaming a temporary file. """
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w', encoding='utf8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    tmp.rename(path)
+
+
+def file_identity(path):
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
 
 
 class PtyProcessError(RuntimeError):
@@ -109,13 +457,13 @@ def pty_process(command):
             raise PtyProcessError()
 
 
-def pty_ssh(remote, port, password, command):
+def pty_ssh(remote, port, password, command, known_hosts):
     ssh_args = [
         '/usr/bin/ssh', remote,
         '-p', str(port),
         '-o', 'NumberOfPasswordPrompts=1',
         '-o', 'StrictHostKeyChecking=no',
-        '-o', 'UserKnownHostsFile=known_hosts',
+        '-o', 'UserKnownHostsFile={}'.format(known_hosts),
         '-o', 'ConnectTimeout=1',
         command,
     ]
@@ -137,6 +485,347 @@ def pty_ssh(remote, port, password, command):
                 return
 
 
+SNAPSHOT_FORMAT = 3
+
+SNAPSHOT_FILES = [
+    'snapshot.json',
+    'snapshot.state',
+    'snapshot-disk.img',
+    'snapshot-swap.img',
+]
+
+
+def snapshot_key(vm):
+    """ What a memory snapshot of `vm` is only valid for. """
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'arch': get_arch(),
+        'memory': vm.options.memory,
+        'smp': vm.options.smp,
+        'swap': vm.options.swap,
+        'io': vm.io,
+        'accel': accelerator(),
+    }
+
+
+def remove_snapshot(image_dir):
+    for name in SNAPSHOT_FILES:
+        path = image_dir / name
+        if path.exists():
+            path.unlink()
+
+
+READY_CHANNEL = 'org.liquidinvestigations.factory.ready'
+READY_MARKER = b'factory-ready'
+
+
+VIRTIOFSD_PATHS = [
+    '/usr/libexec/virtiofsd',
+    '/usr/lib/qemu/virtiofsd',
+]
+
+
+def find_virtiofsd():
+    found = shutil.which('virtiofsd')
+    if found:
+        return found
+    for path in VIRTIOFSD_PATHS:
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def ksm_running():
+    try:
+        with open('/sys/kernel/mm/ksm/run', encoding='latin1') as f:
+            return f.read().strip() == '1'
+    except FileNotFoundError:
+        return False
+
+
+# MiB of translated code that TCG keeps per VM; big enough for a booted
+# userspace, so hot code isn't retranslated over and over
+TCG_TB_SIZE = 512
+
+# emulation is much slower than KVM, so waits for the guest last longer
+TIMEOUT_SCALE = {
+    'kvm': 1,
+    'tcg': 10,
+}
+
+
+@lru_cache()
+def accelerator():
+    """
+    Use KVM if we can open `/dev/kvm`, otherwise fall back to emulating the
+    guest with TCG, e.g. in containers or on cloud runners without nested
+    virtualization.
+    """
+    if os.access('/dev/kvm', os.R_OK | os.W_OK):
+        return 'kvm'
+    logger.warning("/dev/kvm is not available, emulating the VM with TCG; "
+                   "expect it to be a lot slower")
+    return 'tcg'
+
+
+def accel_args():
+    if accelerator() == 'kvm':
+        return ['-enable-kvm', '-cpu', 'host']
+    return [
+        # one host thread per vCPU, instead of a single thread for all
+        '-accel', 'tcg,thread=multi,tb-size={}'.format(TCG_TB_SIZE),
+        # every CPU feature TCG can emulate
+        '-cpu', 'max',
+    ]
+
+
+def scale_timeout(seconds):
+    return seconds * TIMEOUT_SCALE[accelerator()]
+
+
+IO_PROFILES = {
+    # throwaway overlays: nothing on them has to survive a host crash, so
+    # guest flushes are ignored
+    'ephemeral': {
+        'cache': 'unsafe',
+        'aio': 'io_uring',
+        'iothread': True,
+        'multiqueue': True,
+    },
+    # `--persist` writes to the image itself, so flushes reach the disk
+    'durable': {
+        'cache': 'writeback',
+        'aio': 'io_uring',
+        'iothread': True,
+        'multiqueue': True,
+    },
+    # qemu's defaults, which factory used before there were profiles
+    'default': {
+        'cache': 'writeback',
+        'aio': 'threads',
+        'iothread': False,
+        'multiqueue': False,
+    },
+}
+
+
+@lru_cache()
+def qemu_supports_io_uring():
+    """ Check if qemu and the kernel can do disk I/O with io_uring. """
+    with TemporaryDirectory() as tmp:
+        probe = Path(tmp) / 'probe.img'
+        probe.touch()
+        result = subprocess.run([
+            'qemu-img', 'info', '--image-opts',
+            'driver=raw,file.driver=file,file.aio=io_uring,file.filename={}'
+                .format(probe),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+RAM_OVERLAY_ROOT = Path('/dev/shm')
+
+
+def parse_size(size):
+    """ Parse a qemu-style size like `512K`, `300M` or `2G` into bytes. """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def disk_virtual_size(disk):
+    """ The size of the disk that the guest sees, in bytes. """
+    output = subprocess.check_output([
+        'qemu-img', 'info', '-U', '--output=json', str(disk),
+    ])
+    return json.loads(output.decode('utf8'))['virtual-size']
+
+
+def ram_overlay_reserved(root):
+    """
+    Bytes promised to running VMs in `root` but not yet written. Folders left
+    behind by dead processes are removed.
+    """
+    total = 0
+    for folder in root.glob('factory-vm-*'):
+        try:
+            pid = int(folder.name.split('-')[2])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            shutil.rmtree(str(folder), ignore_errors=True)
+            continue
+        except (ValueError, IndexError, PermissionError):
+            continue
+
+        try:
+            with (folder / 'reserved').open(encoding='latin1') as f:
+                reserved = int(f.read())
+            used = sum(f.stat().st_blocks * 512 for f in folder.iterdir())
+        except (FileNotFoundError, ValueError):
+            continue
+        total += max(reserved - used, 0)
+
+    return total
+
+
+def process_start_time(pid):
+    """
+    Start time of a process in clock ticks since boot, which tells a live
+    process apart from a new one that reused its pid. `None` if it's gone.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), encoding='latin1') as f:
+            stat = f.read()
+    except FileNotFoundError:
+        return None
+    # the command name is in parentheses and may contain spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def parse_cpulist(text):
+    """ Parse a CPU list like `0-3,8,10-11` into a set of CPU numbers. """
+    cpus = set()
+    for item in text.strip().split(','):
+        if not item:
+            continue
+        (first, _, last) = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_node_cpus(node):
+    path = Path('/sys/devices/system/node/node{}/cpulist'.format(node))
+    if not path.is_file():
+        raise RuntimeError("There is no NUMA node {}".format(node))
+    with path.open(encoding='latin1') as f:
+        return parse_cpulist(f.read())
+
+
+def local_port_range():
+    with open('/proc/sys/net/ipv4/ip_local_port_range',
+              encoding='latin1') as f:
+        (low, high) = f.read().split()
+    return (int(low), int(high))
+
+
+def port_is_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return False
+    return True
+
+
+class ResourceBroker:
+    """
+    Hands out forwarded ports, CPU cores and guest memory to VMs of all the
+    factory processes on the host. Leases are kept in `resources.json`,
+    guarded by a lock file, and belong to a process; leases of processes
+    that died without releasing them are dropped the next time anyone looks.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.state_path = root / 'resources.json'
+        self.lock_path = root / 'resources.lock'
+
+    @contextmanager
+    def state(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.lock_path.open('w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = load_json(self.state_path) or {'leases': {}}
+            for (lease_id, lease) in list(state['leases'].items()):
+                if process_start_time(lease['pid']) != lease['start_time']:
+                    logger.debug("Dropping lease %s of dead process %d",
+                                 lease_id, lease['pid'])
+                    del state['leases'][lease_id]
+            yield state
+            save_json(self.state_path, state)
+
+    def memory_limit(self):
+        return host_memory('MemTotal')
+
+    def pick_port(self, taken):
+        # stay below the range that the kernel picks outgoing ports from
+        (low, _) = local_port_range()
+        candidates = list(set(range(1025, low)) - taken)
+        random.shuffle(candidates)
+        for port in candidates:
+            if port_is_free(port):
+                return port
+        raise RuntimeError("No free ports left for VMs")
+
+    def try_allocate(self, state, lease_id, memory, cpus, ports,
+                     allowed_cpus):
+        leases = state['leases'].values()
+        committed = sum(lease['memory'] for lease in leases)
+        if committed and committed + memory > self.memory_limit():
+            return None
+
+        taken_ports = {p for lease in leases for p in lease['ports']}
+        lease = {
+            'pid': os.getpid(),
+            'start_time': process_start_time(os.getpid()),
+            'memory': memory,
+            'ports': [],
+            'cpus': [],
+        }
+        for _ in range(ports):
+            lease['ports'].append(self.pick_port(taken_ports))
+            taken_ports.add(lease['ports'][-1])
+
+        # cores are only assigned if each VM can have its own
+        taken_cpus = {c for lease in leases for c in lease['cpus']}
+        free_cpus = sorted(allowed_cpus - taken_cpus)
+        if len(free_cpus) >= cpus:
+            lease['cpus'] = free_cpus[:cpus]
+
+        state['leases'][lease_id] = lease
+        return lease
+
+    @contextmanager
+    def lease(self, memory, cpus, ports=1, allowed_cpus=None, timeout=600):
+        """
+        Reserve `memory` megabytes, `ports` free TCP ports and, if there are
+        enough unassigned cores in `allowed_cpus` (by default, all the cores
+        we may run on), `cpus` of them. Waits for other VMs to finish if the
+        memory committed on the host would exceed its RAM.
+        """
+        if allowed_cpus is None:
+            allowed_cpus = os.sched_getaffinity(0)
+
+        if memory > self.memory_limit():
+            raise RuntimeError("A VM with {}M memory will never fit in {}M "
+                               "host memory".format(memory,
+                                                    self.memory_limit()))
+
+        lease_id = '{}-{}'.format(os.getpid(), os.urandom(4).hex())
+        t0 = time()
+        while True:
+            with self.state() as state:
+                lease = self.try_allocate(state, lease_id, memory, cpus,
+                                          ports, allowed_cpus)
+            if lease is not None:
+                break
+            if time() > t0 + timeout:
+                raise RuntimeError("Host memory still committed to other "
+                                   "VMs after {} seconds".format(timeout))
+            print_progress('Waiting for memory used by other VMs\r')
+            sleep(1)
+
+        logger.debug("Leased ports %r, cpus %r", lease['ports'],
+                     lease['cpus'])
+        try:
+            yield lease
+        finally:
+            with self.state() as state:
+                state['leases'].pop(lease_id, None)
+
+
 DEFAULT_LOGIN = {
     'username': 'ubuntu',
     'password': 'ubuntu',
@@ -145,6 +834,12 @@ DEFAULT_LOGIN = {
 
 @contextmanager
 def instance(options, use_ssh=True):
+    if use_ssh and not options.no_pool:
+        with lease_vm(options) as vm:
+            if vm is not None:
+                yield vm
+                return
+
     vm = VM(options, use_ssh)
     with vm.var_folder():
         with vm.boot():
@@ -153,8 +848,10 @@ def instance(options, use_ssh=True):
 
 class VM:
 
-    def __init__(self, options, use_ssh):
+    def __init__(self, options, use_ssh, disk=None):
         self.platform_home = paths.IMAGES / (options.image or 'cloud')
+        # `factory build` boots the image's config with a layer's disk
+        self.disk = disk or self.platform_home / 'disk.img'
         self.options = options
         self.use_ssh = use_ssh
         self.verbose = options.verbose
@@ -186,44 +883,242 @@ class VM:
         if self.use_ssh:
             self.login = self.config.get('login', DEFAULT_LOGIN)
             self.remote = '{}@localhost'.format(self.login['username'])
-            self.port = random.randint(1025, 65535)
-            self.tcp_ports.append(['127.0.0.1', self.port, 22])
+            self.port = None
 
+            default_mode = self.config.get('share-mode', '9p')
             self.shares = []
             for i, s in enumerate(self.options.share):
-                (path, mountpoint) = s.split(':')
-                self.shares.append((i, Path(path).resolve(), mountpoint))
+                bits = s.split(':')
+                (path, mountpoint) = bits[:2]
+                mode = bits[2] if len(bits) > 2 else default_mode
+                if mode not in ['9p', 'virtiofs']:
+                    raise RuntimeError("Unknown share mode {!r}".format(mode))
+                if mode == 'virtiofs' and not find_virtiofsd():
+                    logger.warning("virtiofsd not found, sharing %s with 9p",
+                                   path)
+                    mode = '9p'
+                self.shares.append((i, Path(path).resolve(), mountpoint, mode))
 
         else:
             assert not self.options.share
+            self.shares = []
+
+        self.pin_cpus = (
+            self.options.pin_cpus or self.config.get('pin-cpus', False)
+        )
+        self.numa_node = self.options.numa_node
+        if self.numa_node is None:
+            self.numa_node = self.config.get('numa-node')
+        self.hugepages = (
+            self.options.hugepages or self.config.get('hugepages', False)
+        )
+        if self.hugepages and free_hugepages() < self.options.memory:
+            logger.warning("Not enough free hugepages for %dM of guest "
+                           "memory, using normal pages", self.options.memory)
+            self.hugepages = False
+
+        self.io = self.io_settings()
+
+        self.density = (
+            self.options.density or self.config.get('density', False)
+        )
+        if self.density and not ksm_running():
+            logger.warning("KSM is not running on the host, identical "
+                           "guest pages won't be merged")
+
+        self.resume = self.use_ssh and self.has_snapshot()
+
+    def has_snapshot(self):
+        """
+        Check if the image has a memory snapshot that matches this run. The
+        snapshot doesn't include shared folders or extra drives, and it's
+        only valid for the exact `disk.img` it was taken from.
+        """
+        if self.options.cold_boot or self.options.persist:
+            return False
+
+        if self.shares or self.cdrom_paths or self.usb_storage_paths:
+            return False
+
+        # a snapshot can't be resumed with a different memory layout
+        if self.memory_backend() or self.density:
+            return False
+
+        snapshot_json = self.platform_home / 'snapshot.json'
+        if not snapshot_json.is_file():
+            return False
+
+        with snapshot_json.open(encoding='utf8') as f:
+            snapshot = json.load(f)
+
+        return snapshot == {
+            'disk': file_identity(self.disk),
+            'key': snapshot_key(self),
+        }
+
+    def io_settings(self):
+        """
+        Settings for the VM's disks, from `--io-profile`, the image's
+        `io-profile` or, by default, the profile for the run mode. The
+        image's `io-settings` can override single settings of the profile.
+        `--persist` writes to the image itself, so unless `--io-profile` is
+        given it always uses the `durable` profile.
+        """
+        overrides = dict(self.config.get('io-settings', {}))
+        if self.options.io_profile:
+            name = self.options.io_profile
+        elif self.options.persist:
+            name = 'durable'
+            if self.config.get('io-profile', name) != name:
+                logger.warning("Ignoring the image's %r I/O profile, "
+                               "--persist needs %r",
+                               self.config['io-profile'], name)
+            if overrides.get('cache') == 'unsafe':
+                logger.warning("Ignoring the image's unsafe cache setting, "
+                               "--persist needs flushes to reach the disk")
+                del overrides['cache']
+        else:
+            name = self.config.get('io-profile', 'ephemeral')
+        if name not in IO_PROFILES:
+            raise RuntimeError("Unknown I/O profile {!r}".format(name))
+
+        settings = dict(IO_PROFILES[name])
+        settings.update(overrides)
+        if settings['aio'] == 'io_uring' and not qemu_supports_io_uring():
+            logger.debug("io_uring is not supported, using a thread pool")
+            settings['aio'] = 'threads'
+        return settings
 
     def setup_var(self):
         with (self.var / 'id_ed25519').open('w', encoding='latin1') as f:
             f.write(SSH_PRIVKEY)
         (self.var / 'id_ed25519').chmod(0o600)
 
-        disk_img = self.platform_home / 'disk.img'
+        disk_img = self.disk
         self.local_disk = self.var / 'local-disk.img'
 
         if self.options.persist:
+            if disk_img == self.platform_home / 'disk.img':
+                # the memory snapshot won't match the disk after this run
+                remove_snapshot(self.platform_home)
+                unshare_blob(disk_img)
             self.local_disk.symlink_to(disk_img)
 
         else:
-            subprocess.run([
-                'qemu-img', 'create', '-q',
-                '-f', 'qcow2',
-                '-b', str(disk_img),
-                str(self.local_disk),
-            ], check=True)
+            if self.resume:
+                disk_img = self.platform_home / 'snapshot-disk.img'
+
+            with tracer.phase('vm.create_overlay'):
+                subprocess.run([
+                    'qemu-img', 'create', '-q',
+                    '-f', 'qcow2',
+                    '-b', str(disk_img),
+                    str(self.scratch_path('local-disk.img')),
+                ], check=True)
+
+    def setup_ram_overlay(self):
+        """
+        For `--ram-overlay`, create a folder in tmpfs for the throwaway disks
+        and reserve room for them. The overlay can't hold more than the
+        disk's virtual size, and the swap disk is fixed, so the reservation
+        covers the most they can grow. If that is over the optional cap, or
+        tmpfs can't fit it on top of what other VMs have reserved, the disks
+        stay in the var folder. The reservations are checked and made under
+        the `ResourceBroker` lock.
+        """
+        self.ram_overlay = None
+        enabled = self.options.ram_overlay or self.config.get('ram-overlay')
+        if not enabled or self.options.persist:
+            return
+
+        cap = (
+            self.options.ram_overlay_size
+            or self.config.get('ram-overlay-size')
+        )
+        cap = None if cap is None else parse_size(cap)
+        # qcow2 metadata is well under 1% of the data it maps
+        size = disk_virtual_size(self.disk) * 101 // 100
+        if self.use_ssh and self.options.swap:
+            size += parse_size(self.options.swap)
+        if cap is not None and size > cap:
+            logger.warning(
+                "The disks can grow to %d MiB, over the %d MiB RAM overlay "
+                "cap, keeping them on disk", size >> 20, cap >> 20,
+            )
+            return
+
+        root = RAM_OVERLAY_ROOT
+        if not root.is_dir():
+            logger.warning("%s is missing, keeping disks on disk", root)
+            return
+
+        with ResourceBroker(paths.VAR).state():
+            free = (shutil.disk_usage(str(root)).free
+                    - ram_overlay_reserved(root))
+            if free < size:
+                logger.warning(
+                    "Not enough room in %s for a %d MiB overlay, keeping "
+                    "disks on disk", root, size >> 20,
+                )
+                return
+
+            self.ram_overlay = Path(mkdtemp(
+                prefix='factory-vm-{}-'.format(os.getpid()),
+                dir=str(root),
+            ))
+            with (self.ram_overlay / 'reserved').open(
+                    'w', encoding='latin1') as f:
+                f.write(str(size))
+        logger.debug("Throwaway disks are in %s", self.ram_overlay)
+
+    def scratch_path(self, name):
+        """
+        Path for a throwaway disk. With a RAM overlay, the file lives in tmpfs
+        and is linked from the var folder.
+        """
+        path = self.var / name
+        if self.ram_overlay is not None:
+            path.symlink_to(self.ram_overlay / name)
+            return self.ram_overlay / name
+        return path
 
     @contextmanager
     def var_folder(self):
         if not paths.VAR.is_dir():
             paths.VAR.mkdir()
 
-        with TemporaryDirectory(prefix='vm-', dir=str(paths.VAR)) as var:
+        with TemporaryDirectory(prefix='vm-', dir=str(paths.VAR)) as var, \
+                self.reserve_resources():
             self.var = Path(var)
-            self.setup_var()
+            self.setup_ram_overlay()
+            try:
+                with tracer.phase('vm.setup_var'):
+                    self.setup_var()
+                yield
+            finally:
+                if self.ram_overlay is not None:
+                    shutil.rmtree(str(self.ram_overlay))
+
+    @contextmanager
+    def reserve_resources(self):
+        """
+        Lease the ssh port, cores and memory for this VM from the host-wide
+        `ResourceBroker`, so that concurrent VMs don't collide.
+        """
+        broker = ResourceBroker(paths.VAR)
+        allowed_cpus = None
+        if self.numa_node is not None:
+            allowed_cpus = numa_node_cpus(self.numa_node)
+        with broker.lease(
+            memory=self.options.memory,
+            cpus=self.options.smp,
+            ports=1 if self.use_ssh else 0,
+            allowed_cpus=allowed_cpus,
+        ) as lease:
+            self.cpus = lease['cpus']
+            if self.use_ssh:
+                self.port = lease['ports'][0]
+                self.tcp_ports.append(['127.0.0.1', self.port, 22])
             yield
 
     def qemu_argv(self):
@@ -236,12 +1131,35 @@ class VM:
             '-chardev', 'socket,id=mon-qmp,path=vm.qmp,server,nowait',
             '-mon', 'chardev=mon-qmp,mode=control',
             '-serial', 'mon:unix:path=vm.mon,server,nowait',
+            '-chardev', 'socket,id=ready,path=vm.ready,server,nowait',
+            '-device', 'virtio-serial',
+            '-device', 'virtserialport,chardev=ready,name=' + READY_CHANNEL,
             '-m', str(self.options.memory),
-            '-enable-kvm',
-            '-cpu', 'host',
-            '-smp', 'cpus={}'.format(self.options.smp),
         ]
 
+        backend = self.memory_backend()
+        if backend:
+            yield from [
+                '-object', ','.join(
+                    [backend, 'id=mem', 'size={}M'.format(self.options.memory)]
+                    + ['{}={}'.format(k, v) for (k, v) in self.memory_props()]
+                ),
+                '-numa', 'node,memdev=mem',
+            ]
+
+        yield from accel_args()
+        yield from ['-smp', 'cpus={}'.format(self.options.smp)]
+
+        if self.density:
+            yield from [
+                # let KSM merge identical pages across VMs
+                '-machine', 'mem-merge=on',
+                # the guest hands back memory it frees, and the balloon can
+                # shrink idle VMs
+                '-device', 'virtio-balloon-pci,id=balloon0,'
+                    'free-page-reporting=on,deflate-on-oom=on',
+            ]
+
         if arch == 'aarch64':
             yield from [
                 '-M', 'virt',
@@ -268,14 +1186,27 @@ class VM:
             '-device', 'virtio-net-pci,netdev=user,romfile=',
         ]
 
-        def disk_drive(path):
-            return [
-                '-drive',
-                'if=virtio,discard=unmap,detect-zeroes=unmap,file={}'
-                    .format(path),
+        if self.io['iothread']:
+            yield from ['-object', 'iothread,id=iothread0']
+
+        def disk_drive(path, name):
+            drive = [
+                'if=none',
+                'id=' + name,
+                'file={}'.format(path),
+                'discard=unmap',
+                'detect-zeroes=unmap',
+                'cache=' + self.io['cache'],
+                'aio=' + self.io['aio'],
             ]
+            device = ['virtio-blk-pci', 'drive=' + name]
+            if self.io['iothread']:
+                device.append('iothread=iothread0')
+            if self.io['multiqueue']:
+                device.append('num-queues={}'.format(self.options.smp))
+            return ['-drive', ','.join(drive), '-device', ','.join(device)]
 
-        yield from disk_drive(self.var / 'local-disk.img')
+        yield from disk_drive(self.var / 'local-disk.img', 'disk')
 
         for path in self.cdrom_paths:
             yield from ['-drive', 'file={},media=cdrom'.format(path)]
@@ -289,24 +1220,40 @@ class VM:
             ]
 
         if self.use_ssh:
-            for i, path, _ in self.shares:
+            for i, path, _, mode in self.shares:
+                # virtiofs shares also get a 9p device, for guest kernels
+                # that don't support virtiofs
                 yield from [
                     '-fsdev', 'local,id=fsdev{i},security_model=none,path={path}'
                         .format(i=i, path=path),
                     '-device', 'virtio-9p-pci,fsdev=fsdev{i},mount_tag=path{i}'
                         .format(i=i),
                 ]
+                if mode == 'virtiofs':
+                    yield from [
+                        '-chardev', 'socket,id=virtiofs{i},'
+                            'path=virtiofs{i}.sock'.format(i=i),
+                        '-device', 'vhost-user-fs-pci,chardev=virtiofs{i},'
+                            'tag=fs{i}'.format(i=i),
+                    ]
 
             if self.options.swap:
-                swap_disk = str(self.var / 'swap.img')
+                swap_disk = str(self.scratch_path('swap.img'))
+                if self.resume:
+                    swap_args = ['-b', str(
+                        self.platform_home / 'snapshot-swap.img'
+                    )]
+                else:
+                    swap_args = []
                 subprocess.run([
                     'qemu-img', 'create', '-q',
                     '-f', 'qcow2',
+                ] + swap_args + [
                     swap_disk,
                     self.options.swap,
                 ], check=True)
 
-                yield from disk_drive(swap_disk)
+                yield from disk_drive(swap_disk, 'swap')
 
         if self.options.vnc:
             assert 5900 <= self.options.vnc <= 5999
@@ -316,9 +1263,87 @@ class VM:
         if self.options.sdl:
             yield from ['-display', 'sdl']
 
+        if self.resume:
+            state = self.platform_home / 'snapshot.state'
+            yield from [
+                '-incoming',
+                'exec:cat {}'.format(shlex.quote(str(state))),
+            ]
+
         yield from self.config.get('qemu-args', [])
 
-    def vm_bootstrap_commands(self):
+    def memory_backend(self):
+        """
+        The qemu memory backend for guest RAM, if it needs more than plain
+        anonymous memory, configured by `memory_props`.
+        """
+        if self.memory_props():
+            return 'memory-backend-memfd'
+        return None
+
+    def memory_props(self):
+        props = []
+        if any(mode == 'virtiofs' for (_, _, _, mode) in self.shares):
+            # vhost-user needs to map guest RAM into virtiofsd
+            props.append(('share', 'on'))
+        if self.hugepages:
+            # allocate up front; a guest that runs out of hugepages later
+            # gets killed with SIGBUS
+            props += [('hugetlb', 'on'), ('prealloc', 'on')]
+        if self.numa_node is not None:
+            props += [('host-nodes', self.numa_node), ('policy', 'bind')]
+        return props
+
+    def bind_numa_node(self):
+        """ Run all of qemu's threads on the cores of `--numa-node`. """
+        cpus = numa_node_cpus(self.numa_node)
+        for task in Path('/proc/{}/task'.format(self.qemu.pid)).iterdir():
+            try:
+                os.sched_setaffinity(int(task.name), cpus)
+            except ProcessLookupError:
+                pass
+
+    def pin_vcpus(self):
+        """ Pin each vCPU thread to one of the cores leased for this VM. """
+        if len(self.cpus) < self.options.smp:
+            logger.warning("Not enough free cores to pin the vCPUs")
+            return
+
+        for vcpu in self.qmp.execute('query-cpus-fast'):
+            cpu = self.cpus[vcpu['cpu-index']]
+            os.sched_setaffinity(vcpu['thread-id'], {cpu})
+            logger.debug("Pinned vCPU %d to core %d", vcpu['cpu-index'], cpu)
+
+    def start_virtiofsd(self, timeout=10):
+        virtiofsd = find_virtiofsd()
+        for i, path, _, mode in self.shares:
+            if mode != 'virtiofs':
+                continue
+
+            socket_path = self.var / 'virtiofs{}.sock'.format(i)
+            command = [
+                virtiofsd,
+                '--socket-path', str(socket_path),
+                '--shared-dir', str(path),
+                '--cache', 'auto',
+            ]
+            if os.getuid() != 0:
+                command += ['--sandbox', 'none']
+            logger.debug('+ ' + ' '.join(command))
+            self.helpers.append(subprocess.Popen(command))
+
+            t0 = time()
+            while not socket_path.exists():
+                if time() > t0 + timeout:
+                    raise RuntimeError("virtiofsd did not create its socket")
+                sleep(.05)
+
+    def vm_login_commands(self):
+        """ Commands that run with password login, to install our key. """
+        if self.resume:
+            yield 'true'
+            return
+
         yield from [
             'mkdir -p ~/.ssh',
             'echo "{}" >> ~/.ssh/authorized_keys'.format(SSH_PUBKEY),
@@ -326,13 +1351,27 @@ class VM:
             'chmod 600 ~/.ssh/authorized_keys',
         ]
 
-        for i, _, mountpoint in self.shares:
+    def vm_bootstrap_commands(self):
+        """ Commands that run through the ssh master connection. """
+        if self.resume:
+            # the snapshot was taken after bootstrap; only fix the clock
+            yield 'sudo hwclock --hctosys || true'
+            return
+
+        for i, _, mountpoint, mode in self.shares:
             quoted_mountpoint = shlex.quote(mountpoint)
             yield 'sudo mkdir -p {}'.format(quoted_mountpoint)
-            yield (
+            mount_9p = (
                 'sudo mount -t 9p -o trans=virtio path{} {} -oversion=9p2000.L'
                 .format(i, quoted_mountpoint)
             )
+            if mode == 'virtiofs':
+                # `check_share_modes` reports if this falls back to 9p
+                yield '{{ sudo mount -t virtiofs fs{} {} || {}; }}'.format(
+                    i, quoted_mountpoint, mount_9p,
+                )
+            else:
+                yield mount_9p
 
         if self.options.swap:
             yield from [
@@ -340,34 +1379,148 @@ class VM:
                 'sudo swapon /dev/vdb',
             ]
 
-    def vm_bootstrap(self, timeout=180):
-        if self.verbose:
-            console_socat = subprocess.Popen([
-                'socat', '-',
-                str(self.var / 'vm.mon'),
-            ])
-
+    def vm_bootstrap(self, timeout=None):
+        if timeout is None:
+            timeout = scale_timeout(180)
         password = self.login['password']
-        bootstrap = ' && '.join(self.vm_bootstrap_commands())
+        login = ' && '.join(self.vm_login_commands())
         t0 = time()
-        while time() < t0 + timeout:
-            try:
-                print_progress('.')
-                pty_ssh(self.remote, self.port, password, bootstrap)
-
-            except PtyProcessError:
-                sleep(1)
-                continue
+        with tracer.phase('vm.wait_until_ready'):
+            self.wait_until_ready(timeout)
+        self.ready_time = time() - self.boot_time
+        with tracer.phase('vm.ssh_login'):
+            while time() < t0 + timeout:
+                try:
+                    print_progress('.')
+                    pty_ssh(self.remote, self.port, password, login,
+                            self.var / 'known_hosts')
+
+                except PtyProcessError:
+                    sleep(1)
+                    continue
+
+                else:
+                    print_progress(
+                        ':) ready in {:.1f}s\n'.format(self.ready_time)
+                    )
+                    break
 
             else:
-                print_progress(':)\n')
-                return
+                raise RuntimeError(
+                    "VM not up after {} seconds".format(timeout)
+                )
+
+        with tracer.phase('vm.ssh_master'):
+            self.open_ssh_master()
+        bootstrap = list(self.vm_bootstrap_commands())
+        if bootstrap:
+            with tracer.phase('vm.bootstrap_commands'):
+                subprocess.run(self.ssh_command(' && '.join(bootstrap)),
+                               check=True)
+        if not self.resume:
+            self.check_share_modes()
+
+    def check_share_modes(self):
+        """
+        The guest mounts a virtiofs share with 9p if virtiofs fails, e.g.
+        without kernel support; look up the filesystem that was actually
+        mounted, so `self.shares` tells which protocol is in use.
+        """
+        virtiofs = [share for share in self.shares if share[3] == 'virtiofs']
+        if not virtiofs:
+            return
+
+        output = subprocess.check_output(self.ssh_command(' && '.join(
+            'findmnt -n -o FSTYPE --mountpoint {}'.format(shlex.quote(mp))
+            for (_, _, mp, _) in virtiofs
+        )))
+        mounted = dict(zip(
+            [share[0] for share in virtiofs],
+            output.decode('latin1').split(),
+        ))
+        for (n, (i, path, mountpoint, mode)) in enumerate(self.shares):
+            fstype = mounted.get(i, mode)
+            if fstype != mode:
+                logger.warning("The guest couldn't mount %s with %s, it's "
+                               "shared with %s", path, mode, fstype)
+                self.shares[n] = (i, path, mountpoint, fstype)
+
+    def wait_until_ready(self, timeout):
+        """
+        Wait for sshd to come up in the guest, without spawning processes.
+        Images made by `prepare-cloud-image` write `READY_MARKER` to a
+        virtio-serial port once sshd is started. For other images, and for
+        VMs resumed from a snapshot, we also probe the forwarded ssh port
+        until the server sends its banner.
+        """
+        selector = selectors.DefaultSelector()
+        marker = open_socket(str(self.var / 'vm.ready'))
+        if marker is not None:
+            marker.setblocking(False)
+            selector.register(marker, selectors.EVENT_READ, 'marker')
+
+        received = b''
+        probe = None
+        probe_time = next_probe = 0
+        t0 = time()
 
-        raise RuntimeError("VM not up after {} seconds".format(timeout))
+        def close_probe(delay):
+            nonlocal probe, next_probe
+            selector.unregister(probe)
+            probe.close()
+            probe = None
+            next_probe = time() + delay
+
+        try:
+            while time() < t0 + timeout:
+                if probe is None and time() >= next_probe:
+                    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    probe.setblocking(False)
+                    probe.connect_ex(('127.0.0.1', self.port))
+                    selector.register(probe, selectors.EVENT_READ, 'banner')
+                    probe_time = time()
+
+                for (key, _) in selector.select(timeout=.1):
+                    try:
+                        data = key.fileobj.recv(1024)
+                    except OSError:
+                        data = b''
+
+                    if key.data == 'marker':
+                        if not data:
+                            selector.unregister(marker)
+                            continue
+                        received = (received + data)[-1024:]
+                        if READY_MARKER in received:
+                            logger.debug("Guest signalled it is ready")
+                            return
+
+                    else:
+                        if data.startswith(b'SSH-'):
+                            logger.debug("Guest ssh server is up")
+                            return
+                        # slirp accepts the connection and drops it if
+                        # nothing listens in the guest
+                        close_probe(.25)
+
+                if probe is not None and time() > probe_time + 1:
+                    close_probe(0)
+
+            raise RuntimeError("VM not up after {} seconds".format(timeout))
+
+        finally:
+            if probe is not None:
+                probe.close()
+            if marker is not None:
+                marker.close()
+            selector.close()
 
     def wait_for_qemu_sockets(self, timeout=30):
         t0 = time()
-        files = [self.var / name for name in ['vm.qmp', 'vm.mon']]
+        files = [
+            self.var / name
+            for name in ['vm.qmp', 'vm.mon', 'vm.ready']
+        ]
 
         while time() < t0 + timeout:
             if all(f.exists() for f in files):
@@ -377,85 +1530,494 @@ class VM:
         else:
             raise RuntimeError("VM did not create its sockets")
 
-    def shutdown(self, timeout=60):
-        if self.use_ssh:
+    def status(self):
+        return self.qmp.execute('query-status')['status']
+
+    def set_balloon(self, memory):
+        """ Ask the guest to shrink or grow to `memory` megabytes. """
+        self.qmp.execute('balloon', value=memory << 20)
+
+    def rss(self):
+        """ Host memory used by qemu, in megabytes. """
+        qemu = getattr(self, 'qemu', None)
+        if qemu is None:
+            return None
+        try:
+            with open('/proc/{}/status'.format(qemu.pid),
+                      encoding='latin1') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) // 1024
+        except FileNotFoundError:
+            pass
+        return None
+
+    def save_snapshot(self, timeout=None):
+        """
+        Save the VM's memory and disks next to `disk.img`, so that later runs
+        can resume from this point instead of booting.
+        """
+        if timeout is None:
+            timeout = scale_timeout(300)
+        if self.memory_backend() or self.density:
+            raise RuntimeError("Snapshots can't be taken with --hugepages, "
+                               "--numa-node, --density or virtiofs shares")
+
+        remove_snapshot(self.platform_home)
+        state = self.platform_home / 'snapshot.state'
+        tmp_state = self.platform_home / 'snapshot.state.tmp'
+
+        self.qmp.execute('stop')
+        self.qmp.execute('migrate-set-capabilities', capabilities=[
+            {'capability': 'events', 'state': True},
+        ])
+        self.qmp.execute('migrate', uri='exec:cat > {}'.format(
+            shlex.quote(str(tmp_state))
+        ))
+
+        t0 = time()
+        while True:
+            remaining = t0 + timeout - time()
+            try:
+                event = self.qmp.wait_event(['MIGRATION'], remaining)
+            except asyncio.TimeoutError:
+                raise RuntimeError("VM state not saved after {} seconds"
+                                   .format(timeout))
+            if event is None:
+                raise RuntimeError("VM stopped while saving its state")
+
+            status = event['data']['status']
+            if status == 'completed':
+                break
+            if status in ['failed', 'cancelled']:
+                raise RuntimeError("Saving VM state {}".format(status))
+
+        tmp_state.rename(state)
+        shutil.copy(
+            str(self.var / 'local-disk.img'),
+            str(self.platform_home / 'snapshot-disk.img'),
+        )
+        if self.options.swap:
+            shutil.copy(
+                str(self.var / 'swap.img'),
+                str(self.platform_home / 'snapshot-swap.img'),
+            )
+
+        # written last, it marks the snapshot as complete
+        with (self.platform_home / 'snapshot.json').open(
+                'w', encoding='utf8') as f:
+            json.dump({
+                'disk': file_identity(self.platform_home / 'disk.img'),
+                'key': snapshot_key(self),
+            }, f)
+
+    def shutdown(self, timeout=None):
+        if timeout is None:
+            timeout = scale_timeout(60)
+        with tracer.phase('vm.shutdown'):
+            self.power_off(timeout)
+
+    def power_off(self, timeout):
+        if self.use_ssh and self.ssh_master_running():
             try:
                 self.ssh('sudo poweroff')
-            except:
+            except subprocess.CalledProcessError as e:
+                # 255: the guest closed the connection as it went down
+                if e.returncode != 255:
+                    raise RuntimeError("poweroff failed in the VM with "
+                                       "status {}".format(e.returncode))
+        elif self.use_ssh:
+            # we can't reach the guest, so press the power button
+            try:
+                self.qmp.execute('system_powerdown')
+            except QMPError:
                 pass
 
         print_progress("Waiting for the VM to shut down ")
         t0 = time()
-        while time() < t0 + timeout:
-            if open_qmp('vm.qmp') is None:
-                # the socket is dead, so the VM must have stopped
-                print_progress('\n')
-                return
-            print_progress('.')
-            sleep(.2)
-
+        try:
+            self.qmp.wait_event(['SHUTDOWN'], timeout)
+        except asyncio.TimeoutError:
+            print_progress('\n')
+            raise RuntimeError("VM did not shut down normally")
+
+        # let qemu close the disks before boot() kills it
+        try:
+            self.qmp.execute('quit')
+        except QMPError:
+            pass
+        try:
+            self.qemu.wait(max(t0 + timeout - time(), 1))
+        except subprocess.TimeoutExpired:
+            pass
         print_progress('\n')
-        raise RuntimeError("VM did not shut down normally")
 
     @contextmanager
     def boot(self):
-        with cd(self.var):
-            qemu_cmd = list(self.qemu_argv())
-            logger.debug('+ ' + ' '.join(qemu_cmd))
-            self.qemu = subprocess.Popen(qemu_cmd)
+        # qemu resolves its socket paths relative to the var folder; we don't
+        # chdir there because a pool or batch runs many VMs in one process
+        qemu_cmd = list(self.qemu_argv())
+        logger.debug('+ ' + ' '.join(qemu_cmd))
+        self.boot_time = time()
+        self.timings = {}
+        self.helpers = []
+        self.qemu = None
+        self.qmp = None
+        self.console_log = None
+        booted = False
+        try:
+            if self.use_ssh:
+                with tracer.phase('vm.start_virtiofsd'):
+                    self.start_virtiofsd()
+            with tracer.phase('vm.qemu_sockets', resume=self.resume):
+                self.qemu = subprocess.Popen(qemu_cmd, cwd=str(self.var))
+                self.wait_for_qemu_sockets()
+            self.timings['qemu_sockets'] = time() - self.boot_time
+            self.start_console_log()
+            self.qmp = QMP(str(self.var / 'vm.qmp'))
+            if self.numa_node is not None:
+                self.bind_numa_node()
+            if self.pin_cpus:
+                self.pin_vcpus()
+
+            if self.use_ssh:
+                t0 = time()
+                with tracer.phase('vm.bootstrap'):
+                    self.vm_bootstrap()
+                self.timings['bootstrap'] = time() - t0
 
-            self.wait_for_qemu_sockets()
+            booted = True
+            yield
 
-            try:
-                if self.use_ssh:
-                    self.vm_bootstrap()
+            if self.options.persist:
+                self.shutdown()
 
-                yield
+        finally:
+            with tracer.phase('vm.teardown'):
+                if self.use_ssh:
+                    self.close_ssh_master()
+                if self.qmp is not None:
+                    self.qmp.close()
+                for process in [self.qemu] + self.helpers:
+                    if process is not None:
+                        process.kill()
+                        process.wait()
+                if self.console_log is not None:
+                    if not booted:
+                        self.save_console_tail()
+                    self.console_log.close()
+
+    def start_console_log(self):
+        """
+        Record the serial console to `console.log` in the var folder, and
+        show it on stderr with `--verbose`.
+        """
+        sock = open_socket(str(self.var / 'vm.mon'))
+        if sock is None:
+            logger.warning("Can't connect to the VM's serial console")
+            return
+
+        self.console_log = ConsoleLog(self.var / 'console.log', sock)
+        if self.verbose:
+            self.console_log.listeners.append(self.show_console_output)
+        console_reader.register(self.console_log)
 
-                if self.options.persist:
-                    self.shutdown()
+    @staticmethod
+    def show_console_output(data):
+        sys.stderr.buffer.write(data)
+        sys.stderr.buffer.flush()
+
+    def save_console_tail(self):
+        """ Keep the end of the console output of a VM that failed to boot. """
+        tail = self.console_log.tail()
+        # the var folder is about to be removed, and other VMs may fail too
+        path = paths.VAR / 'failed-boot-{}-{}.log'.format(
+            int(time()), self.var.name,
+        )
+        path.write_bytes(tail)
+        logger.error("The VM failed to boot. The last %d bytes of its "
+                     "console output are in %s", len(tail), path)
 
-            finally:
-                self.qemu.kill()
-                self.qemu.wait()
+        logs = sorted(paths.VAR.glob('failed-boot-*.log'),
+                      key=lambda log: log.stat().st_mtime)
+        for old in logs[:-FAILED_BOOT_LOGS]:
+            try:
+                old.unlink()
+            except FileNotFoundError:
+                # removed by another VM that failed at the same time
+                pass
 
     @staticmethod
     def invoke_ssh(cmd):
         subprocess.run(cmd, check=True)
 
-    @staticmethod
-    def invoke_console(socket_path):
-        subprocess.run(['socat', '-,cfmakeraw,escape=0xf', str(socket_path)])
-
-    def ssh(self, cmd=None):
-        ssh_command = [
-            'ssh',
-            self.remote,
+    def ssh_options(self):
+        # every connection goes through the master, if there is one
+        return [
             '-p', str(self.port),
-            '-o', 'UserKnownHostsFile=known_hosts',
+            '-o', 'UserKnownHostsFile={}'.format(self.var / 'known_hosts'),
             '-o', 'StrictHostKeyChecking=no',
             '-o', 'ConnectTimeout=30',
             '-o', 'IdentitiesOnly=yes',
-            '-i', 'id_ed25519',
+            '-i', str(self.var / 'id_ed25519'),
+            '-o', 'ControlPath={}'.format(self.var / 'ssh.ctl'),
         ]
 
+    def ssh_command(self, cmd=None):
+        ssh_command = ['ssh', self.remote] + self.ssh_options()
+
         if cmd:
             ssh_command.append(cmd)
 
-        self.invoke_ssh(ssh_command)
+        return ssh_command
 
-    def console(self):
-        self.invoke_console(self.var / 'vm.mon')
+    def open_ssh_master(self):
+        subprocess.run(
+            ['ssh', self.remote] + self.ssh_options() + [
+                '-o', 'ControlMaster=yes',
+                '-o', 'ControlPersist=yes',
+                '-N', '-f',
+            ],
+            check=True,
+        )
 
+    def ssh_master_running(self):
+        return subprocess.run(
+            ['ssh', self.remote] + self.ssh_options() + ['-O', 'check'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode == 0
+
+    def close_ssh_master(self):
+        if not (self.var / 'ssh.ctl').exists():
+            return
+
+        subprocess.run(
+            ['ssh', self.remote] + self.ssh_options() + ['-O', 'exit'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
 
-def add_vm_arguments(parser):
-    parser.add_argument('-v', '--verbose', action='store_true')
-    parser.add_argument('-i', '--image')
-    parser.add_argument('--share', action='append', default=[])
-    parser.add_argument('-m', '--memory', default=512, type=int)
-    parser.add_argument('-s', '--smp', default=1, type=int)
-    parser.add_argument('--restrict-network', action='store_true')
-    parser.add_argument('--tcp', action='append', default=[])
+    def ssh(self, cmd=None):
+        self.invoke_ssh(self.ssh_command(cmd))
+
+    def inject(self, host_path, guest_path):
+        """
+        Copy `host_path` (a folder's contents, or a file) into the guest
+        folder `guest_path`, as a gzipped tar stream over ssh.
+        """
+        t0 = time()
+        tar = subprocess.Popen(
+            ['tar', 'c'] + tar_source_args(Path(host_path)),
+            stdout=subprocess.PIPE,
+        )
+        ssh = subprocess.Popen(
+            self.ssh_command(sudo_command(['bash', '-c', GUEST_UNTAR,
+                                           'bash', guest_path])),
+            stdin=subprocess.PIPE,
+        )
+        with tracer.phase('vm.inject', path=str(host_path)):
+            destination = CountingWriter(ssh.stdin)
+            try:
+                with tar.stdout, ssh.stdin:
+                    size = compress_stream(tar.stdout, destination, 'gzip',
+                                           os.cpu_count())
+            except BrokenPipeError:
+                tar.kill()
+                tar.wait()
+                raise RuntimeError(
+                    "Failed to copy {} into the VM: ssh exited with status "
+                    "{}".format(host_path, ssh.wait())
+                )
+            if tar.wait() != 0 or ssh.wait() != 0:
+                raise RuntimeError(
+                    "Failed to copy {} into the VM: tar exited with status "
+                    "{}, ssh with {}".format(host_path, tar.returncode,
+                                             ssh.returncode)
+                )
+        log_throughput("Copied {} into the VM:".format(host_path),
+                       size, destination.count, time() - t0)
+
+    def collect(self, guest_path, host_path):
+        """
+        Copy the guest's `guest_path` (a folder's contents, or a file) into
+        the folder `host_path`, as a gzipped tar stream over ssh.
+        """
+        t0 = time()
+        Path(host_path).mkdir(parents=True, exist_ok=True)
+        ssh = subprocess.Popen(
+            self.ssh_command(sudo_command(['bash', '-c', GUEST_TAR,
+                                           'bash', guest_path])),
+            stdout=subprocess.PIPE,
+        )
+        tar = subprocess.Popen(
+            ['tar', 'x', '-C', str(host_path)],
+            stdin=subprocess.PIPE,
+        )
+        compressed_size = size = 0
+
+        def chunks():
+            nonlocal compressed_size
+            for chunk in iter(lambda: ssh.stdout.read(COPY_CHUNK_SIZE), b''):
+                compressed_size += len(chunk)
+                yield chunk
+
+        with tracer.phase('vm.collect', path=guest_path):
+            try:
+                with ssh.stdout, tar.stdin:
+                    for data in gunzip_chunks(chunks()):
+                        size += len(data)
+                        tar.stdin.write(data)
+            except BrokenPipeError:
+                ssh.kill()
+                ssh.wait()
+                raise RuntimeError(
+                    "Failed to copy {} from the VM: tar exited with status "
+                    "{}".format(guest_path, tar.wait())
+                )
+            if ssh.wait() != 0 or tar.wait() != 0:
+                raise RuntimeError(
+                    "Failed to copy {} from the VM: ssh exited with status "
+                    "{}, tar with {}".format(guest_path, ssh.returncode,
+                                             tar.returncode)
+                )
+        log_throughput("Copied {} from the VM:".format(guest_path),
+                       size, compressed_size, time() - t0)
+
+    @contextmanager
+    def transfer(self, inject, collect):
+        """
+        Context manager for `--inject` and `--collect`: copy files into the
+        VM, and copy results out when the block exits, even if it failed. If
+        the block failed, errors while collecting are only logged, so that
+        the block's own error is the one that gets reported.
+        """
+        for spec in inject:
+            (host_path, guest_path) = spec.rsplit(':', 1)
+            self.inject(host_path, guest_path)
+
+        def collect_all(failed):
+            for spec in collect:
+                (guest_path, host_path) = spec.split(':', 1)
+                try:
+                    self.collect(guest_path, host_path)
+                except Exception as e:
+                    if not failed:
+                        raise
+                    logger.error("Failed to collect %s: %s", guest_path, e)
+
+        try:
+            yield
+        except Exception:
+            collect_all(failed=True)
+            raise
+        collect_all(failed=False)
+
+    def console(self, escape=b'\x0f'):
+        """
+        Connect the terminal to the serial console until the `escape` key
+        (ctrl-o) is typed, starting with the output recorded so far.
+        """
+        if self.console_log is None:
+            raise RuntimeError("The VM's serial console is not available")
+
+        stdin = sys.stdin.fileno()
+        stdout = sys.stdout.fileno()
+        saved_mode = None
+        if os.isatty(stdin):
+            saved_mode = termios.tcgetattr(stdin)
+            tty.setraw(stdin)
+
+        def show(data):
+            os.write(stdout, data)
+
+        show(self.console_log.tail())
+        self.console_log.listeners.append(show)
+        try:
+            while True:
+                data = os.read(stdin, 1024)
+                (data, escaped, _) = data.partition(escape)
+                if data:
+                    self.console_log.send(data)
+                if escaped or not data:
+                    break
+
+        finally:
+            self.console_log.listeners.remove(show)
+            if saved_mode is not None:
+                termios.tcsetattr(stdin, termios.TCSADRAIN, saved_mode)
+
+
+POOL_INCOMPATIBLE_OPTIONS = ['share', 'tcp', 'udp', 'cdrom', 'usb_storage']
+
+
+def pool_key(options):
+    """
+    Describe the VM requested by `options` so it can be matched against the
+    pool. Returns `None` if a pooled VM can't satisfy the request, e.g.
+    because it needs extra devices, port forwards or a persistent disk.
+    """
+    if options.persist or options.vnc or options.sdl:
+        return None
+
+    if any(getattr(options, name) for name in POOL_INCOMPATIBLE_OPTIONS):
+        return None
+
+    return {
+        'image': options.image or 'cloud',
+        'memory': options.memory,
+        'smp': options.smp,
+        'swap': options.swap,
+        'restrict_network': options.restrict_network,
+        'cold_boot': options.cold_boot,
+        'ram_overlay': options.ram_overlay,
+        'pin_cpus': options.pin_cpus,
+        'numa_node': options.numa_node,
+        'hugepages': options.hugepages,
+        'io_profile': options.io_profile,
+        'density': options.density,
+    }
+
+
+@contextmanager
+def lease_vm(options):
+    """
+    Lease a booted VM from a running `factory pool`. Yields `None` if there
+    is no pool, or it has no matching VM. The pool destroys the VM as soon
+    as we hang up.
+    """
+    key = pool_key(options)
+    sock = open_socket(str(paths.SOCKET)) if key else None
+    if sock is None:
+        yield None
+        return
+
+    with sock:
+        t0 = time()
+        with tracer.phase('pool.lease'):
+            send_message(sock, {'type': 'lease', 'key': key})
+            reply = read_message(sock.makefile('rb'))
+
+        if not reply or not reply['vm']:
+            logger.debug("No matching VM in the pool")
+            yield None
+            return
+
+        logger.info("Leased VM from pool in {:.3f}s".format(time() - t0))
+        vm = VM(options, use_ssh=True)
+        vm.var = Path(reply['vm']['var'])
+        vm.port = reply['vm']['port']
+        yield vm
+
+
+def add_vm_arguments(parser):
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-i', '--image')
+    parser.add_argument('--share', action='append', default=[])
+    parser.add_argument('-m', '--memory', default=512, type=int)
+    parser.add_argument('-s', '--smp', default=1, type=int)
+    parser.add_argument('--restrict-network', action='store_true')
+    parser.add_argument('--tcp', action='append', default=[])
     parser.add_argument('--udp', action='append', default=[])
     parser.add_argument('--vnc', type=int)
     parser.add_argument('--sdl', action='store_true')
@@ -463,18 +2025,616 @@ def add_vm_arguments(parser):
     parser.add_argument('--usb-storage', action='append', default=[])
     parser.add_argument('--swap', default='2G')
     parser.add_argument('--persist', action='store_true')
+    parser.add_argument('--no-pool', action='store_true')
+    parser.add_argument('--cold-boot', action='store_true')
+    parser.add_argument('--ram-overlay', action='store_true')
+    parser.add_argument('--ram-overlay-size')
+    parser.add_argument('--pin-cpus', action='store_true')
+    parser.add_argument('--numa-node', type=int)
+    parser.add_argument('--hugepages', action='store_true')
+    parser.add_argument('--io-profile', choices=sorted(IO_PROFILES))
+    parser.add_argument('--density', action='store_true')
+
+
+class RequestArgumentParser(ArgumentParser):
+    """
+    Parses arguments sent by a client: errors are raised as `RuntimeError`,
+    with the usage message, instead of exiting this process. What it prints,
+    e.g. for `--help`, is kept in `output` for the client, and its
+    `SystemExit` with status 0 is let through.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output = []
+
+    def _print_message(self, message, file=None):
+        if message:
+            self.output.append(message)
+
+    def error(self, message):
+        raise RuntimeError("{}\n{}: error: {}".format(
+            self.format_usage().strip(), self.prog, message,
+        ))
+
+    def exit(self, status=0, message=None):
+        if status == 0:
+            super().exit(status, message)
+        raise RuntimeError((message or '').strip() or
+                           "Arguments rejected with status {}".format(status))
+
+
+def run_parser(parser_class=ArgumentParser):
+    parser = parser_class()
+    add_vm_arguments(parser)
+    parser.add_argument('--no-daemon', action='store_true')
+    parser.add_argument('--inject', action='append', default=[],
+                        metavar='HOST_PATH:GUEST_PATH',
+                        help="copy files into the VM before the command")
+    parser.add_argument('--collect', action='append', default=[],
+                        metavar='GUEST_PATH:HOST_PATH',
+                        help="copy files out of the VM after the command")
+    parser.add_argument('args', nargs=REMAINDER)
+    return parser
+
+
+# `bash -c` scripts that run in the guest with the path as `$1`
+GUEST_TAR = (
+    'set -o pipefail; '
+    '[ -e "$1" ] || { echo "$1 not found" >&2; exit 1; }; '
+    'if [ -d "$1" ]; then cd "$1" && tar c .; '
+    'else cd "$(dirname "$1")" && tar c "$(basename "$1")"; fi | gzip -1'
+)
+GUEST_UNTAR = 'mkdir -p "$1" && tar xz -C "$1"'
+
+
+def tar_source_args(path):
+    """ `tar c` arguments to archive a folder's contents, or a file. """
+    if not path.exists():
+        raise RuntimeError("{} not found".format(path))
+    if path.is_dir():
+        return ['-C', str(path), '.']
+    return ['-C', str(path.parent), path.name]
+
+
+def sudo_command(args):
+    return ' '.join(shlex.quote(a) for a in ['sudo'] + args)
 
 
 def run_factory(*args):
+    options = run_parser().parse_args(args)
+
+    if not options.no_daemon:
+        result = submit_to_daemon(args)
+        if result is not None:
+            if result['error']:
+                raise RuntimeError(result['error'])
+            if result['exit_code']:
+                raise subprocess.CalledProcessError(
+                    result['exit_code'], options.args,
+                )
+            return
+
+    with instance(options) as vm:
+        with vm.transfer(options.inject, options.collect):
+            with tracer.phase('command'):
+                vm.ssh(sudo_command(options.args))
+
+
+def meminfo():
+    """ Values from `/proc/meminfo`; sizes are in kilobytes. """
+    values = {}
+    with open('/proc/meminfo', encoding='latin1') as f:
+        for line in f:
+            (label, value) = line.split()[:2]
+            values[label.rstrip(':')] = int(value)
+    return values
+
+
+def host_memory(name):
+    """ A value from `/proc/meminfo`, in megabytes. """
+    try:
+        return meminfo()[name] // 1024
+    except KeyError:
+        raise RuntimeError("Can't find {} in /proc/meminfo".format(name))
+
+
+def free_hugepages():
+    """ Memory in free hugepages of the default size, in megabytes. """
+    values = meminfo()
+    return values.get('HugePages_Free', 0) * values['Hugepagesize'] // 1024
+
+
+def host_memory_available():
+    """ Memory available for new VMs, in megabytes. """
+    return host_memory('MemAvailable')
+
+
+class HostScheduler:
+    """
+    Keeps track of the CPU cores and memory reserved by VMs started from
+    this process, so that their `--smp` and `--memory` never add up to more
+    than the host has.
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        self.cpus = cpus or os.cpu_count()
+        self.memory = memory or host_memory_available()
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.lock = threading.Condition()
+
+    def check(self, cpus, memory):
+        if cpus > self.cpus or memory > self.memory:
+            raise RuntimeError(
+                "A VM with {} cpus and {}M memory will never fit in {} cpus "
+                "and {}M memory".format(cpus, memory, self.cpus, self.memory)
+            )
+
+    def try_reserve(self, cpus, memory):
+        """ Reserve resources if they are free. Call with lock. """
+        if self.used_cpus + cpus > self.cpus:
+            return False
+        if self.used_memory + memory > self.memory:
+            return False
+        self.used_cpus += cpus
+        self.used_memory += memory
+        return True
+
+    def release(self, cpus, memory):
+        with self.lock:
+            self.used_cpus -= cpus
+            self.used_memory -= memory
+            self.lock.notify_all()
+
+
+def job_argv(job):
+    """
+    Convert a job to `factory run` arguments. A job is either a list of
+    arguments, or an object like `{"image": "cloud", "memory": 1024,
+    "share": ["src:/mnt/src"], "command": ["make"]}`.
+    """
+    if isinstance(job, list):
+        return job
+
+    argv = []
+    for (key, value) in sorted(job.items()):
+        if key in ['name', 'command']:
+            continue
+
+        flag = '--' + key.replace('_', '-')
+        for item in (value if isinstance(value, list) else [value]):
+            if item is True:
+                argv.append(flag)
+            elif item not in [False, None]:
+                argv += [flag, str(item)]
+
+    command = job.get('command', [])
+    if isinstance(command, str):
+        command = ['sh', '-c', command]
+
+    return argv + command
+
+
+def run_job(options, output, result):
+    t0 = time()
+    try:
+        with instance(options) as vm:
+            result['boot'] = time() - t0
+            t1 = time()
+            with output.open('wb') as f, \
+                    tracer.phase('command', job=result['name']):
+                result['exit_code'] = subprocess.run(
+                    vm.ssh_command(sudo_command(options.args)),
+                    stdin=subprocess.DEVNULL,
+                    stdout=f,
+                    stderr=subprocess.STDOUT,
+                ).returncode
+            result['run'] = time() - t1
+            result['rss'] = vm.rss()
+
+    except Exception as e:
+        logger.exception("Job %s failed", result['name'])
+        result['error'] = str(e)
+
+    result['total'] = time() - t0
+
+
+def run_jobs(jobs, output_dir, cpus=None, memory=None):
+    """
+    Run `jobs` (see `job_argv`) in parallel VMs, starting each one as soon as
+    the host has enough free cores and memory for it. Each job's output goes
+    to a file in `output_dir`. Returns a list of results with the exit code
+    and timings of each job.
+    """
+    scheduler = HostScheduler(cpus, memory)
+    parser = run_parser()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    pending = deque()
+    results = []
+    for (n, job) in enumerate(jobs):
+        options = parser.parse_args(job_argv(job))
+        scheduler.check(options.smp, options.memory)
+        name = job.get('name') if isinstance(job, dict) else None
+        name = name or str(n)
+        # the name is also the name of the job's output file
+        if '/' in name or name in ('.', '..'):
+            raise RuntimeError("Job name {!r} can't be a file name"
+                               .format(name))
+        if any(result['name'] == name for result in results):
+            raise RuntimeError("Duplicate job name {!r}".format(name))
+        results.append({
+            'name': name,
+            'output': str(output_dir / '{}.log'.format(name)),
+            'exit_code': None,
+        })
+        pending.append((options, results[-1]))
+
+    def run(options, result):
+        try:
+            run_job(options, Path(result['output']), result)
+        finally:
+            scheduler.release(options.smp, options.memory)
+
+    threads = []
+    t0 = time()
+    with scheduler.lock:
+        while pending:
+            # start jobs in order, letting smaller ones fill the gaps
+            for (options, result) in list(pending):
+                if scheduler.try_reserve(options.smp, options.memory):
+                    pending.remove((options, result))
+                    result['wait'] = time() - t0
+                    thread = threading.Thread(
+                        target=run,
+                        args=(options, result),
+                    )
+                    threads.append(thread)
+                    thread.start()
+
+            if pending:
+                scheduler.lock.wait()
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def run_many(*args):
+    parser = ArgumentParser()
+    parser.add_argument('jobs', help="JSON file with a list of jobs")
+    parser.add_argument('-o', '--output-dir', default='run-many-output')
+    parser.add_argument('--cpus', type=int,
+                        help="cores to use, default is all of them")
+    parser.add_argument('--memory', type=int,
+                        help="memory to use in MB, default is all available")
+    parser.add_argument('--report', help="write results as JSON to this file")
+    options = parser.parse_args(args)
+
+    with open(options.jobs, encoding='utf8') as f:
+        jobs = json.load(f)
+
+    t0 = time()
+    results = run_jobs(
+        jobs,
+        Path(options.output_dir),
+        cpus=options.cpus,
+        memory=options.memory,
+    )
+    elapsed = time() - t0
+
+    for result in results:
+        logger.info(
+            "{name}: exit code {exit_code}, waited {wait:.1f}s, "
+            "ran {total:.1f}s, output in {output}".format(**result)
+        )
+    logger.info("{} jobs done in {:.1f}s".format(len(results), elapsed))
+
+    if options.report:
+        with open(options.report, 'w', encoding='utf8') as f:
+            json.dump({'elapsed': elapsed, 'jobs': results}, f, indent=2)
+
+    failed = [r for r in results if r['exit_code'] != 0]
+    if failed:
+        raise RuntimeError("{} of {} jobs failed".format(
+            len(failed), len(results)
+        ))
+
+
+def timed_ssh(vm, cmd, drop_caches=True):
+    """ Run `cmd` as root in the VM and return the wall-clock seconds. """
+    if drop_caches:
+        subprocess.run(
+            vm.ssh_command(
+                'sync && echo 3 | sudo tee /proc/sys/vm/drop_caches'
+            ),
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    t0 = time()
+    subprocess.run(
+        vm.ssh_command(sudo_command(['sh', '-c', cmd])),
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return time() - t0
+
+
+def make_share_workload(root, files, size):
+    """ Create `files` small files and a `size` MB file under `root`. """
+    for n in range(files):
+        folder = root / 'small' / 'dir{}'.format(n // 100)
+        folder.mkdir(parents=True, exist_ok=True)
+        with (folder / 'file{}'.format(n)).open('wb') as f:
+            f.write(os.urandom(512))
+
+    with (root / 'bulk.bin').open('wb') as f:
+        for _ in range(size):
+            f.write(os.urandom(1 << 20))
+
+
+def bench_share(vm, mountpoint, files, size):
+    metadata = timed_ssh(
+        vm,
+        'find {0}/small -type f | xargs stat > /dev/null && '
+        'for n in $(seq 200); do touch {0}/small/new-$n; done && '
+        'rm {0}/small/new-*'.format(mountpoint),
+    )
+    bulk = timed_ssh(
+        vm,
+        'dd if={}/bulk.bin of=/dev/null bs=1M'.format(mountpoint),
+    )
+    return {
+        'metadata_seconds': metadata,
+        'metadata_ops_per_second': (files + 400) / metadata,
+        'bulk_read_mib_per_second': size / bulk,
+    }
+
+
+def bench_shares(*args):
     parser = ArgumentParser()
     add_vm_arguments(parser)
-    parser.add_argument('args', nargs=REMAINDER)
+    parser.add_argument('--files', type=int, default=2000,
+                        help="small files for the metadata workload")
+    parser.add_argument('--size', type=int, default=256,
+                        help="size in MB of the bulk read file")
     options = parser.parse_args(args)
+    options.no_pool = True
 
-    with instance(options) as vm:
-        args = ['sudo'] + options.args
-        cmd = ' '.join(shlex.quote(a) for a in args)
-        vm.ssh(cmd)
+    if not paths.VAR.is_dir():
+        paths.VAR.mkdir()
+
+    results = {}
+    with TemporaryDirectory(prefix='bench-', dir=str(paths.VAR)) as tmp:
+        tree = Path(tmp)
+        make_share_workload(tree, options.files, options.size)
+
+        for mode in ['9p', 'virtiofs']:
+            options.share = ['{}:/mnt/bench:{}'.format(tree, mode)]
+            with instance(options) as vm:
+                if vm.shares[0][3] != mode:
+                    logger.warning("Skipping %s, it's not available", mode)
+                    continue
+                results[mode] = bench_share(
+                    vm, '/mnt/bench', options.files, options.size,
+                )
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+FAKE_QEMU = r"""
+import sys
+import os
+import json
+import socket
+import threading
+
+# Stand-in for qemu-system-*: creates the server sockets named on the command
+# line and answers QMP, so factory can be benchmarked without a hypervisor.
+
+def serve_qmp(server):
+    (conn, _) = server.accept()
+    reader = conn.makefile('rb')
+    conn.sendall(b'{"QMP": {"version": {"qemu": {"major": 0, "minor": 0, '
+                 b'"micro": 0}, "package": "fake"}, "capabilities": []}}\n')
+    for line in reader:
+        command = json.loads(line.decode('utf8'))
+        name = command['execute']
+        result = {}
+        if name == 'query-status':
+            result = {'status': 'running', 'running': True}
+        if name == 'query-cpus-fast':
+            result = [{'cpu-index': 0, 'thread-id': os.getpid()}]
+        reply = {'return': result, 'id': command.get('id')}
+        conn.sendall(json.dumps(reply).encode('utf8') + b'\n')
+        if name == 'system_powerdown':
+            conn.sendall(b'{"event": "SHUTDOWN", "data": {}}\n')
+        if name in ['quit', 'system_powerdown']:
+            os._exit(0)
+    os._exit(0)
+
+def idle(server):
+    while True:
+        server.accept()
+
+for arg in sys.argv[1:]:
+    if 'path=' not in arg or 'server' not in arg:
+        continue
+    path = arg.split('path=', 1)[1].split(',', 1)[0]
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    target = serve_qmp if path.endswith('.qmp') else idle
+    threading.Thread(target=target, args=(server,), daemon=True).start()
+
+threading.Event().wait()
+"""
+
+
+@contextmanager
+def fake_qemu_on_path():
+    """ Put `FAKE_QEMU` first on `PATH` as `qemu-system-<arch>`. """
+    with TemporaryDirectory(prefix='fake-qemu-') as tmp:
+        fake = Path(tmp) / 'qemu-system-{}'.format(get_arch())
+        with fake.open('w', encoding='utf8') as f:
+            f.write('#!' + sys.executable + '\n' + FAKE_QEMU)
+        fake.chmod(0o755)
+
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = tmp + os.pathsep + old_path
+        try:
+            yield
+        finally:
+            os.environ['PATH'] = old_path
+
+
+def summarize(samples):
+    """ Percentiles of a list of measurements. """
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[int(round(p / 100 * (len(ordered) - 1)))]
+
+    return {
+        'count': len(ordered),
+        'min': ordered[0],
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': ordered[-1],
+        'mean': sum(ordered) / len(ordered),
+    }
+
+
+def bench_once(options, samples):
+    use_ssh = not options.fake_qemu
+    size = options.io_size
+    vm = VM(options, use_ssh)
+
+    with ExitStack() as stack:
+        t0 = time()
+        stack.enter_context(vm.var_folder())
+        samples['overlay_seconds'].append(time() - t0)
+
+        stack.enter_context(vm.boot())
+        samples['qemu_sockets_seconds'].append(vm.timings['qemu_sockets'])
+
+        if use_ssh:
+            samples['ready_seconds'].append(vm.ready_time)
+            samples['bootstrap_seconds'].append(vm.timings['bootstrap'])
+
+            for _ in range(5):
+                t0 = time()
+                subprocess.run(vm.ssh_command('true'), check=True)
+                samples['command_seconds'].append(time() - t0)
+
+            write = timed_ssh(
+                vm,
+                'dd if=/dev/zero of=/var/tmp/bench bs=1M count={} '
+                'oflag=direct'.format(size),
+            )
+            read = timed_ssh(
+                vm,
+                'dd if=/var/tmp/bench of=/dev/null bs=1M iflag=direct',
+            )
+            share = timed_ssh(
+                vm,
+                'dd if=/mnt/bench/bulk.bin of=/dev/null bs=1M',
+            )
+            samples['disk_write_mib_per_second'].append(size / write)
+            samples['disk_read_mib_per_second'].append(size / read)
+            samples['share_read_mib_per_second'].append(size / share)
+
+        else:
+            t0 = time()
+            vm.status()
+            samples['qmp_command_seconds'].append(time() - t0)
+
+        rss = vm.rss()
+        if rss is not None:
+            samples['rss_mib'].append(rss)
+        if not use_ssh:
+            vm.qmp.execute('system_powerdown')
+
+        t0 = time()
+        vm.shutdown()
+        samples['shutdown_seconds'].append(time() - t0)
+
+
+def bench(*args):
+    parser = ArgumentParser()
+    add_vm_arguments(parser)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--io-size', type=int, default=256,
+                        help="MB to write and read for the throughput tests")
+    parser.add_argument('--fake-qemu', action='store_true',
+                        help="use a stand-in for qemu to measure factory's "
+                             "own overhead")
+    parser.add_argument('--compare-io-profiles', action='store_true',
+                        help="run the benchmark with each I/O profile")
+    parser.add_argument('--output', help="also write the results here")
+    options = parser.parse_args(args)
+    options.no_pool = True
+
+    if options.compare_io_profiles:
+        profiles = sorted(IO_PROFILES)
+    else:
+        profiles = [options.io_profile]
+
+    if not paths.VAR.is_dir():
+        paths.VAR.mkdir()
+
+    samples = {profile: defaultdict(list) for profile in profiles}
+    with ExitStack() as stack:
+        if options.fake_qemu:
+            stack.enter_context(fake_qemu_on_path())
+        else:
+            tree = Path(stack.enter_context(
+                TemporaryDirectory(prefix='bench-', dir=str(paths.VAR))
+            ))
+            make_share_workload(tree, 0, options.io_size)
+            options.share = options.share + ['{}:/mnt/bench'.format(tree)]
+
+        for profile in profiles:
+            options.io_profile = profile
+            for n in range(options.repeat):
+                print_progress('Run {}/{}{}\n'.format(
+                    n + 1, options.repeat,
+                    ' with {} I/O'.format(profile) if profile else '',
+                ))
+                bench_once(options, samples[profile])
+
+    def results_for(profile):
+        return {
+            name: summarize(values)
+            for (name, values) in samples[profile].items()
+        }
+
+    results = {
+        'image': options.image or 'cloud',
+        'arch': get_arch(),
+        'accel': accelerator(),
+        'fake_qemu': options.fake_qemu,
+        'repeat': options.repeat,
+        'memory': options.memory,
+        'smp': options.smp,
+    }
+    if options.compare_io_profiles:
+        results['io_profiles'] = {
+            profile: results_for(profile)
+            for profile in profiles
+        }
+    else:
+        results['io_profile'] = options.io_profile
+        results['results'] = results_for(options.io_profile)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if options.output:
+        with open(options.output, 'w', encoding='utf8') as f:
+            f.write(output + '\n')
 
 
 def login(*args):
@@ -495,6 +2655,662 @@ def console(*args):
         vm.console()
 
 
+def snapshot(*args):
+    parser = ArgumentParser()
+    add_vm_arguments(parser)
+    parser.add_argument('--remove', action='store_true')
+    options = parser.parse_args(args)
+
+    if options.remove:
+        remove_snapshot(paths.IMAGES / (options.image or 'cloud'))
+        return
+
+    if options.persist or options.share or options.cdrom \
+            or options.usb_storage:
+        raise RuntimeError("Snapshots can't include --persist, --share, "
+                           "--cdrom or --usb-storage")
+
+    options.no_pool = True
+    options.cold_boot = True
+    with instance(options) as vm:
+        with tracer.phase('vm.save_snapshot'):
+            vm.save_snapshot()
+
+
+class PoolSlot:
+
+    def __init__(self, image):
+        self.image = image
+        self.vm = None
+        self.ready_since = None
+        self.release = threading.Event()
+
+
+class VMPool:
+    """
+    Keeps booted, bootstrapped VMs ready to be leased through `paths.SOCKET`.
+    Each VM is used for a single lease and then thrown away, while a
+    replacement boots in the background.
+    """
+
+    retry_delay = 5
+
+    def __init__(self, vm_args, limits, max_vms=None, idle_timeout=None,
+                 idle_memory=None):
+        self.vm_args = vm_args
+        self.limits = limits
+        self.wanted = dict(limits)
+        self.max_vms = max_vms
+        self.idle_timeout = idle_timeout
+        self.idle_memory = idle_memory
+        self.lock = threading.Condition()
+        self.slots = {image: [] for image in limits}
+        self.ready = {image: deque() for image in limits}
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def vm_options(self, image):
+        parser = ArgumentParser()
+        add_vm_arguments(parser)
+        return parser.parse_args(
+            ['--image', image, '--no-pool'] + self.vm_args
+        )
+
+    def key(self, image):
+        return pool_key(self.vm_options(image))
+
+    def live_count(self):
+        return sum(len(slots) for slots in self.slots.values())
+
+    def maintain(self):
+        """ Boot VMs until each image has its wanted count. Call with lock. """
+        if self.stopping.is_set():
+            return
+
+        for image, slots in sorted(self.slots.items()):
+            while len(slots) < self.wanted[image]:
+                if self.max_vms and self.live_count() >= self.max_vms:
+                    return
+                slot = PoolSlot(image)
+                slots.append(slot)
+                thread = threading.Thread(target=self.run_slot, args=(slot,))
+                self.threads.append(thread)
+                thread.start()
+
+    def run_slot(self, slot):
+        try:
+            with instance(self.vm_options(slot.image)) as vm:
+                if self.idle_memory and vm.density:
+                    vm.set_balloon(self.idle_memory)
+                with self.lock:
+                    slot.vm = vm
+                    slot.ready_since = time()
+                    self.ready[slot.image].append(slot)
+                    self.lock.notify_all()
+                logger.debug("Pooled VM for %r is ready", slot.image)
+                slot.release.wait()
+
+        except Exception:
+            logger.exception("Pooled VM for %r failed", slot.image)
+            self.stopping.wait(self.retry_delay)
+
+        finally:
+            with self.lock:
+                self.slots[slot.image].remove(slot)
+                if slot in self.ready[slot.image]:
+                    self.ready[slot.image].remove(slot)
+                self.maintain()
+                self.lock.notify_all()
+
+    def take(self, key, timeout=None):
+        if timeout is None:
+            timeout = scale_timeout(180)
+        image = key['image']
+        if image not in self.limits or key != self.key(image):
+            return None
+
+        t0 = time()
+        with self.lock:
+            self.wanted[image] = self.limits[image]
+            self.maintain()
+
+            while not self.ready[image]:
+                booting = len(self.slots[image]) > 0
+                if not booting or time() > t0 + timeout:
+                    return None
+                self.lock.wait(1)
+
+            slot = self.ready[image].popleft()
+
+        logger.info("Leased pooled VM for %r after %.3fs idle",
+                    image, time() - slot.ready_since)
+        return slot
+
+    def evict_idle(self):
+        while not self.stopping.wait(1):
+            with self.lock:
+                for image, ready in self.ready.items():
+                    for slot in list(ready):
+                        if time() - slot.ready_since > self.idle_timeout:
+                            logger.info("Evicting idle VM for %r", image)
+                            ready.remove(slot)
+                            self.wanted[image] = max(0, self.wanted[image] - 1)
+                            slot.release.set()
+
+    def handle_connection(self, conn):
+        with conn:
+            reader = conn.makefile('rb')
+            request = read_message(reader)
+            if request is None:
+                return
+            handler = getattr(self, 'handle_' + request['type'], None)
+            if handler is None:
+                send_message(conn, {'error': 'unknown request'})
+                return
+            handler(conn, reader, request)
+
+    def handle_lease(self, conn, reader, request):
+        slot = self.take(request['key'])
+        if slot is None:
+            send_message(conn, {'vm': None})
+            return
+
+        try:
+            if self.idle_memory and slot.vm.density:
+                slot.vm.set_balloon(slot.vm.options.memory)
+            send_message(conn, {'vm': {
+                'var': str(slot.vm.var),
+                'port': slot.vm.port,
+            }})
+            # the lease lasts until the client hangs up
+            reader.read()
+
+        finally:
+            slot.release.set()
+
+    def handle_status(self, conn, reader, request):
+        send_message(conn, self.status())
+
+    def status(self):
+        with self.lock:
+            return {
+                image: {
+                    'ready': len(self.ready[image]),
+                    'live': len(self.slots[image]),
+                    'wanted': self.wanted[image],
+                    'rss': [
+                        slot.vm.rss()
+                        for slot in self.slots[image]
+                        if slot.vm is not None
+                    ],
+                }
+                for image in self.limits
+            }
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            for slots in self.slots.values():
+                for slot in slots:
+                    slot.release.set()
+        for thread in self.threads:
+            thread.join()
+
+    def started(self, socket_path):
+        """ Called by `serve` once the socket is listening. """
+
+    def serve(self, socket_path):
+        if socket_path.exists():
+            sock = open_socket(str(socket_path))
+            if sock is not None:
+                sock.close()
+                raise RuntimeError("A pool is already running")
+            socket_path.unlink()
+
+        for image in self.limits:
+            if self.key(image) is None:
+                raise RuntimeError("Pooled VMs can't use these options")
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(socket_path))
+        server.listen(16)
+        server.settimeout(1)
+
+        try:
+            self.started(socket_path)
+            with self.lock:
+                self.maintain()
+
+            if self.idle_timeout:
+                threading.Thread(target=self.evict_idle, daemon=True).start()
+
+            while not self.stopping.is_set():
+                try:
+                    (conn, _) = server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                threading.Thread(
+                    target=self.handle_connection,
+                    args=(conn,),
+                    daemon=True,
+                ).start()
+
+        finally:
+            server.close()
+            socket_path.unlink()
+            self.stop()
+
+
+def pool_parser():
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--image', action='append', default=[],
+                        help="IMAGE or IMAGE:COUNT, can be repeated")
+    parser.add_argument('-n', '--size', default=2, type=int,
+                        help="VMs to keep ready for each image")
+    parser.add_argument('--max-vms', type=int,
+                        help="limit for the total number of VMs")
+    parser.add_argument('--idle-timeout', type=int,
+                        help="shut down VMs that were not leased for this "
+                             "many seconds, until they are needed again")
+    parser.add_argument('--idle-memory', type=int,
+                        help="with --density, balloon idle VMs down to this "
+                             "many MB until they are leased")
+    return parser
+
+
+def pool_limits(images, size):
+    limits = {}
+    for spec in images:
+        (image, _, count) = spec.partition(':')
+        limits[image] = int(count) if count else size
+    return limits
+
+
+@contextmanager
+def connect_to_pool():
+    sock = open_socket(str(paths.SOCKET))
+    if sock is None:
+        raise RuntimeError("No pool or factoryd is running")
+    with sock:
+        yield (sock, sock.makefile('rb'))
+
+
+def pool(*args):
+    parser = pool_parser()
+    parser.add_argument('--status', action='store_true',
+                        help="show the state of a running pool")
+    # everything else, e.g. `--memory` or `--smp`, configures the pooled VMs
+    (options, vm_args) = parser.parse_known_args(args)
+
+    if options.status:
+        with connect_to_pool() as (sock, reader):
+            send_message(sock, {'type': 'status'})
+            print(json.dumps(read_message(reader), indent=2))
+        return
+
+    if not paths.VAR.is_dir():
+        paths.VAR.mkdir()
+
+    VMPool(
+        vm_args,
+        pool_limits(options.image or ['cloud'], options.size),
+        max_vms=options.max_vms,
+        idle_timeout=options.idle_timeout,
+        idle_memory=options.idle_memory,
+    ).serve(paths.SOCKET)
+
+
+class Job:
+    """
+    A `run` command submitted to `factoryd`. Its output is written to
+    `output_path`, which clients read back from the start.
+    """
+
+    def __init__(self, job_id, argv, options, output_path):
+        self.id = job_id
+        self.argv = argv
+        self.options = options
+        self.state = 'queued'
+        self.output_path = output_path
+        self.output_file = output_path.open('wb')
+        self.output_size = 0
+        self.exit_code = None
+        self.error = None
+        self.vm = None
+        self.process = None
+        self.cancelled = False
+        self.times = {'submitted': time()}
+        self.changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.state in ['finished', 'failed', 'cancelled']
+
+    def set_state(self, state):
+        with self.changed:
+            self.state = state
+            self.times[state] = time()
+            if self.done:
+                self.output_file.close()
+            self.changed.notify_all()
+
+    def append(self, chunk):
+        with self.changed:
+            self.output_file.write(chunk)
+            self.output_file.flush()
+            self.output_size += len(chunk)
+            self.changed.notify_all()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None:
+            self.process.kill()
+        with self.changed:
+            self.changed.notify_all()
+
+    def describe(self):
+        vm = None
+        if self.vm is not None and not self.done:
+            vm = {
+                'var': str(self.vm.var),
+                'port': self.vm.port,
+                'rss': self.vm.rss(),
+            }
+        return {
+            'id': self.id,
+            'argv': self.argv,
+            'state': self.state,
+            'exit_code': self.exit_code,
+            'error': self.error,
+            'times': self.times,
+            'vm': vm,
+        }
+
+
+def resolve_paths(options, cwd):
+    """ Make the host paths in a client's `run` options absolute. """
+    def resolve(path):
+        return os.path.join(cwd, os.path.expanduser(path))
+
+    options.share = [
+        ':'.join([resolve(spec.split(':')[0])] + spec.split(':')[1:])
+        for spec in options.share
+    ]
+    options.cdrom = [resolve(p) for p in options.cdrom]
+    options.usb_storage = [resolve(p) for p in options.usb_storage]
+    options.inject = [
+        ':'.join([resolve(spec.rsplit(':', 1)[0]), spec.rsplit(':', 1)[1]])
+        for spec in options.inject
+    ]
+    options.collect = [
+        ':'.join([spec.split(':', 1)[0], resolve(spec.split(':', 1)[1])])
+        for spec in options.collect
+    ]
+
+
+class Daemon(VMPool):
+    """
+    `factoryd`: a `VMPool` that also runs submitted `run` commands. Jobs
+    wait until the host has room for them, then run concurrently in this
+    process, using pooled VMs when they match. Their output is saved in a
+    folder under `var`, so clients can follow a job from the start at any
+    time.
+    """
+
+    max_history = 100
+
+    def __init__(self, vm_args, limits, cpus=None, memory=None, **kwargs):
+        super().__init__(vm_args, limits, **kwargs)
+        self.scheduler = HostScheduler(cpus, memory)
+        self.jobs = OrderedDict()
+        self.next_id = 1
+        self.output_dir = None
+
+    def started(self, socket_path):
+        self.output_dir = Path(mkdtemp(prefix='jobs-', dir=str(paths.VAR)))
+        logger.info("factoryd listening on %s", socket_path)
+
+    def run_job(self, job):
+        options = job.options
+        with self.scheduler.lock:
+            while not self.scheduler.try_reserve(options.smp, options.memory):
+                if job.cancelled or self.stopping.is_set():
+                    job.set_state('cancelled')
+                    return
+                self.scheduler.lock.wait(1)
+
+        try:
+            job.set_state('booting')
+            with instance(options) as vm:
+                job.vm = vm
+                if job.cancelled:
+                    raise RuntimeError("Cancelled")
+                with vm.transfer(options.inject, options.collect):
+                    job.process = subprocess.Popen(
+                        vm.ssh_command(sudo_command(options.args)),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                    )
+                    job.set_state('running')
+                    with job.process.stdout as output:
+                        for chunk in iter(
+                            lambda: output.read1(COPY_CHUNK_SIZE), b''
+                        ):
+                            job.append(chunk)
+                    job.exit_code = job.process.wait()
+
+        except Exception as e:
+            if not job.cancelled:
+                logger.exception("Job %d failed", job.id)
+            job.error = str(e)
+
+        finally:
+            self.scheduler.release(options.smp, options.memory)
+            if job.cancelled:
+                job.set_state('cancelled')
+            elif job.error is not None:
+                job.set_state('failed')
+            else:
+                job.set_state('finished')
+
+    def submit(self, parser, argv, cwd):
+        options = parser.parse_args(argv)
+        options.no_daemon = True
+        resolve_paths(options, cwd)
+        self.scheduler.check(options.smp, options.memory)
+
+        with self.lock:
+            output_path = self.output_dir / '{}.log'.format(self.next_id)
+            job = Job(self.next_id, argv, options, output_path)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.done]
+            for old in finished[:max(len(finished) - self.max_history, 0)]:
+                del self.jobs[old.id]
+                old.output_path.unlink()
+
+        thread = threading.Thread(target=self.run_job, args=(job,))
+        self.threads.append(thread)
+        thread.start()
+        return job
+
+    def stream(self, conn, job):
+        """ Send the job's output from the start, until it's done. """
+        sent = 0
+        with job.output_path.open('rb') as output:
+            while True:
+                with job.changed:
+                    while job.output_size == sent and not job.done:
+                        job.changed.wait()
+                    size = job.output_size
+                    done = job.done
+                while sent < size:
+                    chunk = output.read(min(size - sent, COPY_CHUNK_SIZE))
+                    send_message(conn, {'output': chunk.decode('latin1')})
+                    sent += len(chunk)
+                if done:
+                    break
+
+        send_message(conn, {
+            'state': job.state,
+            'exit_code': job.exit_code,
+            'error': job.error,
+        })
+
+    def find_job(self, conn, request):
+        with self.lock:
+            job = self.jobs.get(request.get('job'))
+        if job is None:
+            send_message(conn, {'error': 'no such job'})
+        return job
+
+    def handle_submit(self, conn, reader, request):
+        parser = run_parser(RequestArgumentParser)
+        try:
+            job = self.submit(parser, request['argv'], request['cwd'])
+        except RuntimeError as e:
+            send_message(conn, {'error': str(e)})
+            return
+        except SystemExit:
+            # `--help`: answer like a job that printed it and succeeded
+            send_message(conn, {'job': None})
+            send_message(conn, {'output': ''.join(parser.output)})
+            send_message(conn, {'state': 'done', 'exit_code': 0,
+                                'error': None})
+            return
+        send_message(conn, {'job': job.id})
+
+        if request.get('follow'):
+            def cancel_on_hangup():
+                reader.read()
+                if not job.done:
+                    logger.info("Client of job %d hung up", job.id)
+                    job.cancel()
+
+            threading.Thread(target=cancel_on_hangup, daemon=True).start()
+            try:
+                self.stream(conn, job)
+            except OSError:
+                job.cancel()
+
+    def handle_stream(self, conn, reader, request):
+        job = self.find_job(conn, request)
+        if job is not None:
+            self.stream(conn, job)
+
+    def handle_cancel(self, conn, reader, request):
+        job = self.find_job(conn, request)
+        if job is not None:
+            job.cancel()
+            send_message(conn, {'cancelled': job.id})
+
+    def handle_list(self, conn, reader, request):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        send_message(conn, {
+            'jobs': [job.describe() for job in jobs],
+            'pool': self.status(),
+        })
+
+    def stop(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+        super().stop()
+        if self.output_dir is not None:
+            shutil.rmtree(str(self.output_dir))
+
+
+def daemon(*args):
+    parser = pool_parser()
+    parser.set_defaults(size=0)
+    parser.add_argument('--max-cpus', type=int,
+                        help="cores for jobs, default is all of them")
+    parser.add_argument('--max-memory', type=int,
+                        help="memory for jobs in MB, default is all "
+                             "available")
+    (options, vm_args) = parser.parse_known_args(args)
+
+    if not paths.VAR.is_dir():
+        paths.VAR.mkdir()
+
+    Daemon(
+        vm_args,
+        pool_limits(options.image, options.size),
+        cpus=options.max_cpus,
+        memory=options.max_memory,
+        max_vms=options.max_vms,
+        idle_timeout=options.idle_timeout,
+        idle_memory=options.idle_memory,
+    ).serve(paths.SOCKET)
+
+
+def follow_job(sock, reader):
+    """ Copy a job's output to stdout, and return its final message. """
+    while True:
+        message = read_message(reader)
+        if message is None:
+            raise RuntimeError("Lost the connection to factoryd")
+        if 'output' not in message:
+            return message
+        sys.stdout.buffer.write(message['output'].encode('latin1'))
+        sys.stdout.buffer.flush()
+
+
+def submit_to_daemon(args):
+    """
+    Run a `run` command in `factoryd`, if one is running. Returns the job's
+    final message, or `None` if the command should run here.
+    """
+    sock = open_socket(str(paths.SOCKET))
+    if sock is None:
+        return None
+
+    with sock:
+        reader = sock.makefile('rb')
+        send_message(sock, {
+            'type': 'submit',
+            'argv': list(args),
+            'cwd': os.getcwd(),
+            'follow': True,
+        })
+        reply = read_message(reader)
+        if reply is None or reply.get('error') == 'unknown request':
+            # a plain `factory pool`
+            return None
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        if reply['job'] is not None:
+            logger.debug("Submitted job %d to factoryd", reply['job'])
+        return follow_job(sock, reader)
+
+
+def jobs(*args):
+    parser = ArgumentParser()
+    parser.add_argument('--follow', type=int, metavar='JOB',
+                        help="print the output of a job")
+    parser.add_argument('--cancel', type=int, metavar='JOB')
+    options = parser.parse_args(args)
+
+    with connect_to_pool() as (sock, reader):
+        if options.follow:
+            send_message(sock, {'type': 'stream', 'job': options.follow})
+            result = follow_job(sock, reader)
+        elif options.cancel:
+            send_message(sock, {'type': 'cancel', 'job': options.cancel})
+            result = read_message(reader)
+        else:
+            send_message(sock, {'type': 'list'})
+            print(json.dumps(read_message(reader), indent=2))
+            return
+
+    if result.get('error'):
+        raise RuntimeError(result['error'])
+
+
 def create_image(*args):
     parser = ArgumentParser()
     parser.add_argument('image')
@@ -509,30 +3325,483 @@ def create_image(*args):
         str(disk_img),
         options.size,
     ])
+    store_image_files(image_dir)
+
+
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def copy_stream(source, destination, chunk_size=COPY_CHUNK_SIZE):
+    """ Copy file-like `source` to `destination`, return the byte count. """
+    total = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return total
+        destination.write(chunk)
+        total += len(chunk)
+
+
+def parallel_gzip(source, destination, threads, level,
+                  chunk_size=4 * COPY_CHUNK_SIZE):
+    """
+    Compress `source` with a pool of threads, one chunk each; zlib releases
+    the GIL. The output is a series of gzip members, which `gunzip` and
+    `zcat` read like a single stream. Returns the input byte count.
+    """
+    total = 0
+    with ThreadPoolExecutor(threads) as executor:
+        window = deque()
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            total += len(chunk)
+            window.append(executor.submit(gzip.compress, chunk, level))
+            if len(window) > threads * 2:
+                destination.write(window.popleft().result())
+
+        while window:
+            destination.write(window.popleft().result())
+
+    return total
+
+
+class CountingWriter:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.count += len(data)
+
+
+class HashingWriter:
+
+    def __init__(self, digest, stream=None):
+        self.digest = digest
+        self.stream = stream
+
+    def write(self, data):
+        self.digest.update(data)
+        if self.stream is not None:
+            self.stream.write(data)
+
+
+def compress_stream(source, destination, method, threads, level=None):
+    """
+    Compress `source` into `destination` with `method` (`none`, `gzip` or
+    `zstd`). Returns the number of bytes read from `source`.
+    """
+    if method == 'none':
+        return copy_stream(source, destination)
+
+    if method == 'gzip':
+        return parallel_gzip(source, destination, threads, level or 1)
+
+    if method == 'zstd':
+        if not shutil.which('zstd'):
+            raise RuntimeError("zstd compression needs the `zstd` program")
+
+        zstd = subprocess.Popen(
+            [
+                'zstd', '-q', '-c',
+                '-T{}'.format(threads),
+                '-{}'.format(level or 3),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        total = 0
+
+        def feed():
+            nonlocal total
+            with zstd.stdin:
+                total = copy_stream(source, zstd.stdin)
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        copy_stream(zstd.stdout, destination)
+        feeder.join()
+        if zstd.wait() != 0:
+            raise RuntimeError("zstd failed")
+        return total
+
+    raise RuntimeError("Unknown compression {!r}".format(method))
+
+
+def log_throughput(action, size, compressed_size, elapsed):
+    mib = 1 << 20
+    logger.info(
+        "{} {:.1f} MiB ({:.1f} MiB compressed) in {:.1f}s, {:.1f} MiB/s"
+        .format(action, size / mib, compressed_size / mib, elapsed,
+                size / mib / max(elapsed, .001))
+    )
+
+
+def stage_image_for_export(image_dir, staging, qcow2_compress=False,
+                           base=None):
+    """
+    Prepare the files of an export in `staging`. `disk.img` is converted to
+    a standalone qcow2 file, which drops unallocated and zero clusters and
+    flattens backing chains; other files are linked. With a `base` image,
+    `disk.img` only keeps what differs from the base's disk, and files that
+    the base has too are left out and listed in the manifest.
+    """
+    base_info = None
+    if base is not None:
+        base_disk = paths.IMAGES / base / 'disk.img'
+        chain = backing_chain(image_dir / 'disk.img')
+        if not any(Path(layer['filename']).resolve() == base_disk.resolve()
+                   for layer in chain[1:]):
+            raise RuntimeError("Image {} is not based on {}"
+                               .format(image_dir.name, base))
+        base_info = {
+            'image': base,
+            'sha256': disk_content_key(base_disk),
+            'files': {},
+        }
+
+    for file in image_dir.iterdir():
+        if file.name in SNAPSHOT_FILES + [BLOBS_JSON]:
+            continue
+
+        if base is not None and file.name != 'disk.img':
+            base_file = paths.IMAGES / base / file.name
+            if base_file.is_file():
+                digest = file_sha256(file)
+                if file_sha256(base_file) == digest:
+                    base_info['files'][file.name] = digest
+                    continue
+
+        if file.name == 'disk.img':
+            echo_run([
+                'qemu-img', 'convert',
+                '-O', 'qcow2',
+            ] + (['-c'] if qcow2_compress else []) + (
+                ['-B', str(base_disk)] if base is not None else []
+            ) + [
+                str(file),
+                str(staging / 'disk.img'),
+            ])
+
+        else:
+            (staging / file.name).symlink_to(file.resolve())
+
+    write_manifest(staging, base_info)
+
+
+MANIFEST_NAME = 'factory-manifest.json'
+
+
+def write_manifest(folder, base=None):
+    """
+    Save the size and sha256 of every file in `folder` for `import`, and the
+    image that `disk.img` is relative to, if any.
+    """
+    files = sorted(f for f in folder.iterdir() if f.name != MANIFEST_NAME)
+    with ThreadPoolExecutor() as executor:
+        digests = list(executor.map(file_sha256, files))
+
+    manifest = {
+        'files': {
+            file.name: {'size': file.stat().st_size, 'sha256': digest}
+            for (file, digest) in zip(files, digests)
+        },
+    }
+    if base is not None:
+        manifest['base'] = base
+
+    with (folder / MANIFEST_NAME).open('w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def verify_manifest(folder):
+    """
+    Check the files in `folder` against the manifest written by `export`,
+    then remove it. Returns the manifest, or `None` if there was none.
+    """
+    manifest_json = folder / MANIFEST_NAME
+    if not manifest_json.is_file():
+        # archives from before manifests; newer ones have it first, so they
+        # can't lose it by being cut short
+        if not (folder / 'disk.img').is_file():
+            raise RuntimeError("The archive has no manifest and no disk.img, "
+                               "it may be truncated")
+        logger.warning("The archive has no checksum manifest; "
+                       "it can't be verified")
+        return None
+
+    with manifest_json.open(encoding='utf8') as f:
+        manifest = json.load(f)
+    manifest_json.unlink()
+
+    files = sorted(manifest['files'])
+    present = sorted(f.name for f in folder.iterdir())
+    if files != present:
+        raise RuntimeError("Archive files {} don't match the manifest {}"
+                           .format(present, files))
+
+    for name in files:
+        if (folder / name).stat().st_size != manifest['files'][name]['size']:
+            raise RuntimeError("Size mismatch for {}".format(name))
+
+    with ThreadPoolExecutor() as executor:
+        digests = executor.map(file_sha256, [folder / name for name in files])
+        for (name, digest) in zip(files, digests):
+            if digest != manifest['files'][name]['sha256']:
+                raise RuntimeError("Checksum mismatch for {}".format(name))
+
+    return manifest
 
 
 def export_image(*args):
-    image_list = [x.name for x in paths.IMAGES.iterdir() if x.is_dir()]
+    image_list = [
+        x.name for x in paths.IMAGES.iterdir()
+        if x.is_dir() and not x.name.startswith('.')
+    ]
     parser = ArgumentParser()
     parser.add_argument('image', choices=image_list)
+    parser.add_argument('--compress', choices=['none', 'gzip', 'zstd'],
+                        default='none')
+    parser.add_argument('--level', type=int, help="compression level")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help="compression threads, default is all cores")
+    parser.add_argument('--qcow2-compress', action='store_true',
+                        help="also compress clusters inside disk.img")
+    parser.add_argument('--relative-to', metavar='BASE', choices=image_list,
+                        help="only export the changes since image BASE")
     options = parser.parse_args(args)
 
     image_dir = paths.IMAGES / options.image
 
-    with cd(image_dir):
-        subprocess.run(['tar', 'c', '.'], check=True)
+    if not paths.VAR.is_dir():
+        paths.VAR.mkdir()
+
+    with TemporaryDirectory(prefix='export-', dir=str(paths.VAR)) as tmp:
+        staging = Path(tmp)
+        stage_image_for_export(image_dir, staging, options.qcow2_compress,
+                               options.relative_to)
+
+        t0 = time()
+        # the manifest goes first: an archive that's cut short still has
+        # it, and `import` notices the missing files
+        members = sorted(f.name for f in staging.iterdir()
+                         if f.name != MANIFEST_NAME)
+        tar = subprocess.Popen(
+            ['tar', 'c', '-h', '-C', str(staging), MANIFEST_NAME] + members,
+            stdout=subprocess.PIPE,
+        )
+        output = CountingWriter(sys.stdout.buffer)
+        with tar.stdout:
+            size = compress_stream(
+                tar.stdout,
+                output,
+                options.compress,
+                options.threads,
+                options.level,
+            )
+        sys.stdout.buffer.flush()
+        if tar.wait() != 0:
+            raise RuntimeError("tar failed")
+
+    log_throughput("Exported", size, output.count, time() - t0)
+
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\xfd7zXZ\x00', 'xz'),
+]
+
+
+def detect_compression(head):
+    for (magic, method) in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return method
+    return 'none'
+
+
+def read_ahead(source, chunk_size=COPY_CHUNK_SIZE, depth=8):
+    """
+    Yield chunks of `source`, read by a separate thread so that reading
+    overlaps with whatever the consumer does with them.
+    """
+    chunks = queue.Queue(depth)
+
+    def reader():
+        try:
+            while True:
+                chunk = source.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception:
+            chunks.put(None)
+            raise
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            raise RuntimeError("Error reading input")
+        if not chunk:
+            return
+        yield chunk
+
+
+def gunzip_chunks(chunks, max_length=16 * COPY_CHUNK_SIZE):
+    """ Decompress a (possibly multi-member) gzip stream. """
+    decompressor = None
+    for chunk in chunks:
+        while chunk:
+            if decompressor is None:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            yield decompressor.decompress(chunk, max_length)
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = None
+            else:
+                chunk = decompressor.unconsumed_tail
+
+    if decompressor is not None:
+        raise RuntimeError("The gzip stream is truncated")
+
+
+def decompress_stream(head, source, destination, method):
+    """
+    Decompress `head` followed by the rest of `source` into `destination`,
+    a binary file object. Returns the number of compressed bytes read.
+    """
+    total = 0
+
+    def chunks():
+        nonlocal total
+        total += len(head)
+        yield head
+        for chunk in read_ahead(source):
+            total += len(chunk)
+            yield chunk
+
+    if method == 'none':
+        for chunk in chunks():
+            destination.write(chunk)
+
+    elif method == 'gzip':
+        for data in gunzip_chunks(chunks()):
+            destination.write(data)
+
+    elif method in ['zstd', 'xz']:
+        if not shutil.which(method):
+            raise RuntimeError("Decompressing {0} needs the `{0}` program"
+                               .format(method))
+        command = [method, '-d', '-c', '-q']
+        if method == 'xz':
+            command.append('-T0')
+
+        decompressor = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=destination,
+        )
+        with decompressor.stdin:
+            for chunk in chunks():
+                decompressor.stdin.write(chunk)
+        if decompressor.wait() != 0:
+            raise RuntimeError("{} failed".format(method))
+
+    else:
+        raise RuntimeError("Unknown compression {!r}".format(method))
+
+    return total
+
+
+def rebase_imported_disk(staging, base_info, base):
+    """
+    Point the `disk.img` of an archive exported with `--relative-to` at the
+    local copy of its base image, if that has the same content.
+    """
+    base = base or base_info['image']
+    base_disk = paths.IMAGES / base / 'disk.img'
+    if not base_disk.is_file():
+        raise RuntimeError("The archive is relative to image {}, which is "
+                           "missing".format(base))
+    if disk_content_key(base_disk) != base_info['sha256']:
+        raise RuntimeError("Image {} is not the one the archive was "
+                           "exported relative to".format(base))
+
+    for (name, digest) in sorted(base_info.get('files', {}).items()):
+        base_file = paths.IMAGES / base / name
+        if not base_file.is_file() or file_sha256(base_file) != digest:
+            raise RuntimeError("Image {} doesn't have the {} the archive "
+                               "was exported with".format(base, name))
+
+    # the content is the same, so only the backing file name changes
+    echo_run([
+        'qemu-img', 'rebase', '-u',
+        '-b', str(base_disk),
+        str(staging / 'disk.img'),
+    ])
+    # like `fork`, link the files that the base provides
+    for name in base_info.get('files', {}):
+        (staging / name).symlink_to(paths.IMAGES / base / name)
 
 
 def import_image(*args):
     parser = ArgumentParser()
     parser.add_argument('image')
+    parser.add_argument('--base',
+                        help="base image for an archive exported with "
+                             "--relative-to, if it's named differently here")
     options = parser.parse_args(args)
 
     image_dir = paths.IMAGES / options.image
-    image_dir.mkdir(parents=True)
+    if image_dir.exists():
+        raise RuntimeError("Image {} already exists".format(options.image))
+
+    # unpack next to the final folder, so we can move it there atomically
+    staging = Path(mkdtemp(prefix='.import-', dir=str(paths.IMAGES)))
+    try:
+        t0 = time()
+        source = sys.stdin.buffer
+        head = source.read(8)
+        method = detect_compression(head)
+        logger.debug("Importing %s archive", method)
+
+        tar = subprocess.Popen(
+            ['tar', 'x', '-C', str(staging)],
+            stdin=subprocess.PIPE,
+        )
+        try:
+            with tar.stdin:
+                size = decompress_stream(head, source, tar.stdin, method)
+        finally:
+            returncode = tar.wait()
+        if returncode != 0:
+            raise RuntimeError("tar failed, the archive may be truncated")
+
+        unpacked = sum(f.stat().st_size for f in staging.iterdir())
+        manifest = verify_manifest(staging)
+        digests = {}
+        if manifest and 'base' in manifest:
+            rebase_imported_disk(staging, manifest['base'], options.base)
+        elif manifest:
+            digests = {
+                name: file['sha256']
+                for (name, file) in manifest['files'].items()
+            }
+        # the staging folder is hidden from `gc` until it's in place
+        with BlobStore(paths.BLOBS).in_use():
+            store_image_files(staging, digests)
+            staging.rename(image_dir)
+
+    except:
+        shutil.rmtree(str(staging))
+        raise
 
-    with cd(image_dir):
-        subprocess.run(['tar', 'x'], check=True)
+    log_throughput("Imported", unpacked, size, time() - t0)
 
 
 def fork_image(*args):
@@ -548,6 +3817,9 @@ def fork_image(*args):
     for base_file in base_image_dir.iterdir():
         new_file = new_image_dir / base_file.name
 
+        if base_file.name in SNAPSHOT_FILES + [BLOBS_JSON]:
+            continue
+
         if base_file.name == 'disk.img':
             echo_run([
                 'qemu-img', 'create', '-q',
@@ -570,6 +3842,651 @@ def remove_image(*args):
         file.unlink()
 
     image_dir.rmdir()
+    BlobStore(paths.BLOBS).gc()
+
+
+def backing_chain(disk, share=True):
+    """
+    `qemu-img info` for `disk` and its backing files, top first. With
+    `share`, images that a running VM has open can be read too.
+    """
+    output = subprocess.check_output([
+        'qemu-img', 'info',
+        '--backing-chain',
+        '--output=json',
+    ] + (['-U'] if share else []) + [
+        str(disk),
+    ])
+    chain = json.loads(output.decode('utf8'))
+    return chain if isinstance(chain, list) else [chain]
+
+
+def image_dependents(disk):
+    """ Names of images whose backing chain includes `disk`. """
+    disk = disk.resolve()
+    dependents = []
+    for image_dir in sorted(paths.IMAGES.iterdir()):
+        other = image_dir / 'disk.img'
+        if image_dir.name.startswith('.') or not other.is_file():
+            continue
+        if other.resolve() == disk:
+            continue
+        try:
+            chain = backing_chain(other)
+        except subprocess.CalledProcessError:
+            logger.warning("Can't read the backing chain of image %s",
+                           image_dir.name)
+            continue
+        for layer in chain[1:]:
+            if Path(layer['filename']).resolve() == disk:
+                dependents.append(image_dir.name)
+                break
+    return dependents
+
+
+def compact_image(*args):
+    parser = ArgumentParser()
+    parser.add_argument('image')
+    parser.add_argument('--flatten', action='store_true',
+                        help="don't keep any backing file")
+    parser.add_argument('--compress', action='store_true',
+                        help="write compressed qcow2 clusters")
+    options = parser.parse_args(args)
+
+    disk = paths.IMAGES / options.image / 'disk.img'
+    # fails if a VM is writing to the image, so we don't compact under it
+    before = backing_chain(disk, share=False)
+
+    backing = []
+    if len(before) > 1 and not options.flatten:
+        # merge the intermediate layers, keep the (shared) base image
+        backing = ['-B', before[-1]['filename']]
+
+    # the guest-visible content doesn't change, so images that use this one
+    # as their backing file stay valid
+    dependents = image_dependents(disk)
+    if dependents:
+        logger.info("Used as backing file by: %s", ', '.join(dependents))
+
+    tmp = disk.with_name('disk.img.compact')
+    try:
+        echo_run([
+            'qemu-img', 'convert',
+            '-O', 'qcow2',
+        ] + (['-c'] if options.compress else []) + backing + [
+            str(disk),
+            str(tmp),
+        ])
+        # a hard-linked blob is read-only, the compacted disk is the image's
+        tmp.chmod(disk.stat().st_mode | 0o200)
+        tmp.rename(disk)
+
+    except:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+
+    after = backing_chain(disk)
+    mib = 1 << 20
+    logger.info(
+        "disk.img: {:.1f} MiB -> {:.1f} MiB, chain depth {} -> {}".format(
+            before[0]['actual-size'] / mib,
+            after[0]['actual-size'] / mib,
+            len(before),
+            len(after),
+        )
+    )
+
+
+# files smaller than this aren't worth deduplicating, and stay editable
+BLOB_MIN_SIZE = 1 << 20
+BLOBS_JSON = 'blobs.json'
+
+
+def allocated_size(path):
+    return path.stat().st_blocks * 512
+
+
+def clone_file(source, destination):
+    """
+    Make `destination` a copy of `source` that shares its storage: a reflink
+    if the filesystem supports it, otherwise a hard link, or a plain copy
+    across filesystems. Returns the method used.
+    """
+    result = subprocess.run(
+        ['cp', '--reflink=always', str(source), str(destination)],
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode == 0:
+        return 'reflink'
+    if destination.exists():
+        destination.unlink()
+
+    try:
+        os.link(str(source), str(destination))
+        return 'hardlink'
+    except OSError:
+        shutil.copyfile(str(source), str(destination))
+        return 'copy'
+
+
+class BlobStore:
+    """
+    Content-addressed storage for the big files of images, so that images
+    with the same disk keep its bytes only once. Blobs are stored read-only
+    as `sha256/<digest>`; images hold clones of them (reflinks, or hard
+    links that are copied before a `--persist` run writes to them), and list
+    them in their `blobs.json`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        (self.root / 'sha256').mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest):
+        return self.root / 'sha256' / digest
+
+    @contextmanager
+    def lock(self):
+        with (self.root / '.lock').open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def in_use(self):
+        """
+        Keep `gc` from running while images are being stored, from the first
+        blob until their `blobs.json` is written and they are in place.
+        """
+        with (self.root / '.in-use').open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            yield
+
+    def blobs(self):
+        return [
+            blob for blob in (self.root / 'sha256').iterdir()
+            if not blob.name.endswith('.tmp')
+        ]
+
+    def add(self, path, digest=None):
+        """
+        Store the content of `path`, unless an identical blob exists, and
+        replace `path` with a clone of the blob. Returns the digest.
+        """
+        digest = digest or file_sha256(path)
+        blob = self.blob_path(digest)
+        with self.lock():
+            if blob.exists():
+                method = None
+            else:
+                tmp = blob.with_name(digest + '.tmp')
+                method = clone_file(path, tmp)
+                tmp.chmod(0o444)
+                tmp.rename(blob)
+
+            # a hard link made above already is the blob
+            if method != 'hardlink':
+                staged = path.with_name(path.name + '.blob')
+                method = clone_file(blob, staged)
+                if method != 'hardlink':
+                    staged.chmod(0o644)
+                staged.rename(path)
+
+        logger.debug("Stored %s as blob %s (%s)", path, digest[:12], method)
+        return digest
+
+    def gc(self):
+        """
+        Remove the blobs that no image uses. Waits for images that are being
+        stored. Returns the bytes freed.
+        """
+        with (self.root / '.in-use').open('w') as in_use, self.lock():
+            fcntl.flock(in_use, fcntl.LOCK_EX)
+            used = set()
+            for image_dir in paths.IMAGES.iterdir():
+                if image_dir.is_dir() and not image_dir.name.startswith('.'):
+                    used.update(image_blobs(image_dir).values())
+
+            freed = 0
+            for blob in self.blobs():
+                if blob.name in used:
+                    continue
+                if blob.stat().st_nlink == 1:
+                    freed += allocated_size(blob)
+                blob.unlink()
+                logger.debug("Removed blob %s", blob.name[:12])
+            return freed
+
+
+def store_image_files(image_dir, digests=None):
+    """
+    Move the big files of an image into the blob store and record them in
+    its `blobs.json`. `digests` can give the known sha256 of some files.
+    """
+    store = BlobStore(paths.BLOBS)
+    blobs = {}
+    with store.in_use():
+        for file in sorted(image_dir.iterdir()):
+            if file.is_symlink() or not file.is_file():
+                continue
+            if (file.name in SNAPSHOT_FILES
+                    or file.stat().st_size < BLOB_MIN_SIZE):
+                continue
+            digest = store.add(file, (digests or {}).get(file.name))
+            blobs[file.name] = {
+                'sha256': digest,
+                'identity': file_identity(file),
+            }
+        save_json(image_dir / BLOBS_JSON, blobs)
+
+
+def image_blobs(image_dir):
+    """
+    The blobs an image uses, by file name. Files that changed since they
+    were stored, e.g. by a `--persist` run, no longer count.
+    """
+    blobs = load_json(image_dir / BLOBS_JSON) or {}
+    return {
+        name: blob['sha256'] for (name, blob) in blobs.items()
+        if (image_dir / name).is_file()
+        and file_identity(image_dir / name) == blob['identity']
+    }
+
+
+def unshare_blob(path):
+    """ Give an image its own, writable copy of a hard-linked blob. """
+    stat = path.stat()
+    if stat.st_nlink < 2:
+        # the blob is gone, so the image has the only link left
+        if not stat.st_mode & 0o200:
+            path.chmod(stat.st_mode | 0o200)
+        return
+    logger.info("Copying %s before changing it", path)
+    tmp = path.with_name(path.name + '.unshare')
+    shutil.copyfile(str(path), str(tmp))
+    tmp.chmod(0o644)
+    tmp.rename(path)
+
+
+def disk_usage(*args):
+    parser = ArgumentParser()
+    parser.parse_args(args)
+
+    store = BlobStore(paths.BLOBS)
+    images = {
+        image_dir.name: image_blobs(image_dir)
+        for image_dir in sorted(paths.IMAGES.iterdir())
+        if image_dir.is_dir() and not image_dir.name.startswith('.')
+    }
+    users = defaultdict(int)
+    for blobs in images.values():
+        for digest in set(blobs.values()):
+            users[digest] += 1
+
+    mib = 1 << 20
+    row = '{:<24} {:>12} {:>12}'
+    print(row.format('IMAGE', 'UNIQUE MiB', 'SHARED MiB'))
+    for (name, blobs) in images.items():
+        unique = shared = 0
+        for file in (paths.IMAGES / name).iterdir():
+            if file.is_symlink() or not file.is_file():
+                continue
+            digest = blobs.get(file.name)
+            if (digest and users[digest] > 1
+                    and store.blob_path(digest).exists()):
+                shared += allocated_size(file)
+            else:
+                unique += allocated_size(file)
+        print(row.format(name, '{:.1f}'.format(unique / mib),
+                         '{:.1f}'.format(shared / mib)))
+
+    blobs = store.blobs()
+    saved = sum(
+        allocated_size(blob) * (users[blob.name] - 1)
+        for blob in blobs if users[blob.name] > 1
+    )
+    print("{} blobs, {:.1f} MiB; sharing saves {:.1f} MiB".format(
+        len(blobs),
+        sum(allocated_size(blob) for blob in blobs) / mib,
+        saved / mib,
+    ))
+
+
+def collect_garbage(*args):
+    parser = ArgumentParser()
+    parser.parse_args(args)
+    freed = BlobStore(paths.BLOBS).gc()
+    logger.info("Freed {:.1f} MiB".format(freed / (1 << 20)))
+
+
+def tree_sha256(path):
+    """
+    Digest of a file, or a folder's contents: names, executable bits,
+    symlink targets and file contents, but not timestamps or owners.
+    """
+    if path.is_dir():
+        root = path
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(str(path)):
+            entries.extend(Path(dirpath) / name
+                           for name in dirnames + filenames)
+    else:
+        root = path.parent
+        entries = [path]
+
+    digest = hashlib.sha256()
+    for entry in sorted(entries):
+        name = str(entry.relative_to(root))
+        if entry.is_symlink():
+            record = ['link', name, os.readlink(str(entry))]
+        elif entry.is_dir():
+            record = ['dir', name]
+        else:
+            executable = bool(entry.stat().st_mode & 0o100)
+            record = ['file', name, executable, file_sha256(entry)]
+        digest.update((json.dumps(record) + '\n').encode('utf8'))
+    return digest.hexdigest()
+
+
+def cached_sha256(path):
+    """
+    `file_sha256` of a big file that rarely changes, like an image's disk.
+    Digests are remembered in `digests.json` by path and file identity, so
+    the file is only read again after it changes.
+    """
+    path = path.resolve()
+    digests_json = paths.datadir / 'digests.json'
+
+    @contextmanager
+    def locked():
+        with (paths.datadir / 'digests.lock').open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield load_json(digests_json) or {}
+
+    identity = file_identity(path)
+    with locked() as digests:
+        entry = digests.get(str(path))
+    if entry and entry['identity'] == identity:
+        return entry['sha256']
+
+    sha256 = file_sha256(path)
+    with locked() as digests:
+        digests = {
+            name: value for (name, value) in digests.items()
+            if Path(name).exists()
+        }
+        digests[str(path)] = {'identity': identity, 'sha256': sha256}
+        save_json(digests_json, digests)
+    return sha256
+
+
+def disk_content_key(disk):
+    """ Identify the content of `disk` and its backing files. """
+    digest = hashlib.sha256()
+    for layer in backing_chain(disk):
+        digest.update(cached_sha256(Path(layer['filename'])).encode('latin1'))
+    return digest.hexdigest()
+
+
+class LayerCache:
+    """
+    Disk layers made by `factory build`. Each layer is a qcow2 overlay on its
+    parent layer, or on the recipe's base image, stored as `<key>/disk.img`
+    with its metadata in `<key>/layer.json`. The key hashes the parent's key
+    and the build step, so recipes that start with the same steps share
+    their layers.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.root / key
+
+    @staticmethod
+    def key(parent, step):
+        data = json.dumps({'parent': parent, 'step': step}, sort_keys=True)
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def layers(self):
+        """ Metadata of the complete layers, by key. """
+        return {
+            layer_json.parent.name: load_json(layer_json)
+            for layer_json in self.root.glob('*/layer.json')
+        }
+
+    @contextmanager
+    def in_use(self):
+        """ Keep layers from being evicted while a build runs. """
+        with (self.root / '.lock').open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            yield
+
+    @contextmanager
+    def lock(self, key):
+        """ Stop concurrent builds from making the same layer twice. """
+        with (self.root / (key + '.lock')).open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def touch(self, key):
+        layer_json = self.path(key) / 'layer.json'
+        meta = load_json(layer_json)
+        meta['last_used'] = time()
+        save_json(layer_json, meta)
+
+    def add(self, key, parent_disk, meta, build):
+        """
+        Create layer `key` on top of `parent_disk` and call `build` with the
+        new disk. The layer is only added to the cache if `build` succeeds.
+        """
+        tmp = self.root / (key + '.tmp')
+        if tmp.exists():
+            shutil.rmtree(str(tmp))
+        tmp.mkdir()
+        try:
+            disk = tmp / 'disk.img'
+            subprocess.run([
+                'qemu-img', 'create', '-q',
+                '-f', 'qcow2',
+                '-b', str(parent_disk),
+                str(disk),
+            ], check=True)
+            build(disk)
+            meta = dict(meta, size=disk.stat().st_blocks * 512,
+                        created=time(), last_used=time())
+            save_json(tmp / 'layer.json', meta)
+            tmp.rename(self.path(key))
+
+        except:
+            shutil.rmtree(str(tmp), ignore_errors=True)
+            raise
+
+    def used_by_images(self):
+        """ Keys of the layers in the backing chains of images. """
+        root = self.root.resolve()
+        used = set()
+        for image_dir in paths.IMAGES.iterdir():
+            disk = image_dir / 'disk.img'
+            if image_dir.name.startswith('.') or not disk.is_file():
+                continue
+            try:
+                chain = backing_chain(disk)
+            except subprocess.CalledProcessError:
+                # we can't tell which layers it needs, so keep them all
+                logger.warning("Can't read the backing chain of image %s",
+                               image_dir.name)
+                return set(self.layers())
+            for layer in chain[1:]:
+                path = Path(layer['filename']).resolve()
+                if path.parent.parent == root:
+                    used.add(path.parent.name)
+        return used
+
+    def evict(self, max_size, max_age):
+        """
+        Remove layers that weren't used for `max_age` seconds, then the
+        least recently used ones until the cache fits in `max_size` bytes.
+        Layers that images or other layers are based on are kept. Returns
+        the evicted keys; nothing is evicted while a build is running.
+        """
+        with (self.root / '.lock').open('w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("A build is running, not evicting layers")
+                return []
+
+            layers = self.layers()
+            keep = self.used_by_images()
+            total = sum(meta['size'] for meta in layers.values())
+            now = time()
+            evicted = []
+            while True:
+                parents = {meta['parent'] for meta in layers.values()}
+                candidates = sorted(
+                    (meta['last_used'], key)
+                    for (key, meta) in layers.items()
+                    if key not in parents and key not in keep
+                )
+                if not candidates:
+                    break
+                (last_used, key) = candidates[0]
+                if total <= max_size and now - last_used <= max_age:
+                    break
+
+                shutil.rmtree(str(self.path(key)))
+                lock_path = self.root / (key + '.lock')
+                if lock_path.exists():
+                    lock_path.unlink()
+                total -= layers.pop(key)['size']
+                evicted.append(key)
+
+            return evicted
+
+
+def build_step_key(step, recipe_dir):
+    """ What a build step's layer depends on, for the layer key. """
+    if set(step) == {'run'}:
+        return {'run': step['run']}
+    if set(step) == {'copy'}:
+        (host_path, guest_path) = step['copy'].rsplit(':', 1)
+        return {
+            'copy': guest_path,
+            'sha256': tree_sha256(recipe_dir / host_path),
+        }
+    raise RuntimeError("Unknown build step {!r}".format(step))
+
+
+def run_build_step(options, disk, step, recipe_dir):
+    """ Boot a VM with `disk` and apply `step` to it. """
+    vm = VM(options, use_ssh=True, disk=disk)
+    with vm.var_folder():
+        with vm.boot():
+            if 'run' in step:
+                vm.ssh(sudo_command(['sh', '-c', step['run']]))
+            else:
+                (host_path, guest_path) = step['copy'].rsplit(':', 1)
+                vm.inject(recipe_dir / host_path, guest_path)
+
+
+def build_image(*args):
+    parser = ArgumentParser()
+    parser.add_argument('recipe')
+    parser.add_argument('--name',
+                        help="image to create; defaults to the recipe's "
+                             "file name without the extension")
+    parser.add_argument('--cache-size', default='20G',
+                        help="evict the least recently used layers once the "
+                             "cache is bigger than this")
+    parser.add_argument('--cache-age', default=30, type=int,
+                        help="evict layers unused for this many days")
+    options = parser.parse_args(args)
+
+    recipe_path = Path(options.recipe).resolve()
+    recipe_dir = recipe_path.parent
+    with recipe_path.open(encoding='utf8') as f:
+        recipe = json.load(f)
+
+    name = options.name or recipe_path.stem
+    base = recipe.get('base', 'cloud')
+    base_dir = paths.IMAGES / base
+    image_dir = paths.IMAGES / name
+    if image_dir.exists() and not (image_dir / 'build.json').is_file():
+        raise RuntimeError("Image {!r} exists and wasn't made by `factory "
+                           "build`".format(name))
+
+    vm_parser = ArgumentParser()
+    add_vm_arguments(vm_parser)
+    vm_options = vm_parser.parse_args(
+        ['--image', base, '--persist', '--no-pool']
+        + recipe.get('options', [])
+    )
+
+    cache = LayerCache(paths.LAYERS)
+    steps = recipe.get('steps', [])
+    report = []
+    with cache.in_use():
+        parent = 'base:' + disk_content_key(base_dir / 'disk.img')
+        parent_disk = base_dir / 'disk.img'
+        for (n, step) in enumerate(steps, 1):
+            key = cache.key(parent, build_step_key(step, recipe_dir))
+            t0 = time()
+            with tracer.phase('build.step', step=n, key=key), cache.lock(key):
+                cached = cache.path(key).is_dir()
+                if cached:
+                    cache.touch(key)
+                else:
+                    logger.info("Step %d/%d: %s", n, len(steps),
+                                json.dumps(step))
+                    cache.add(
+                        key, parent_disk,
+                        {'parent': parent, 'step': step},
+                        lambda disk: run_build_step(vm_options, disk, step,
+                                                    recipe_dir),
+                    )
+            report.append({
+                'step': step,
+                'key': key,
+                'cached': cached,
+                'seconds': round(time() - t0, 3),
+            })
+            logger.info("Step %d/%d: %s in %.1fs (%s)", n, len(steps),
+                        'cached' if cached else 'built', time() - t0,
+                        key[:12])
+            parent = key
+            parent_disk = cache.path(key) / 'disk.img'
+
+        if image_dir.exists():
+            remove_image(name)
+        image_dir.mkdir()
+        for base_file in base_dir.iterdir():
+            if base_file.name in SNAPSHOT_FILES + [
+                    'disk.img', 'build.json', BLOBS_JSON]:
+                continue
+            (image_dir / base_file.name).symlink_to(base_file)
+        # runs with `--persist` change the image, not the cached layer
+        subprocess.run([
+            'qemu-img', 'create', '-q',
+            '-f', 'qcow2',
+            '-b', str(parent_disk),
+            str(image_dir / 'disk.img'),
+        ], check=True)
+        save_json(image_dir / 'build.json', {
+            'recipe': str(recipe_path),
+            'base': base,
+            'steps': report,
+        })
+
+    hits = sum(1 for step in report if step['cached'])
+    logger.info("Built %s: %d of %d steps from the layer cache",
+                name, hits, len(report))
+
+    evicted = cache.evict(parse_size(options.cache_size),
+                          options.cache_age * 24 * 3600)
+    if evicted:
+        logger.info("Evicted %d layers from the cache", len(evicted))
 
 
 CLOUD_INIT_YML = """\
@@ -577,34 +4494,204 @@ CLOUD_INIT_YML = """\
 password: ubuntu
 chpasswd: { expire: False }
 ssh_pwauth: True
+write_files:
+  - path: /etc/systemd/system/factory-ready.service
+    content: |
+      [Unit]
+      Description=Tell factory that sshd is up
+      After=ssh.service
+      Wants=ssh.service
+
+      [Service]
+      Type=oneshot
+      ExecStart=-/bin/sh -c 'echo factory-ready > /dev/virtio-ports/org.liquidinvestigations.factory.ready'
+
+      [Install]
+      WantedBy=multi-user.target
 runcmd:
   - "echo '127.0.1.1 ubuntu' >> /etc/hosts"
+  - "systemctl enable factory-ready.service"
   - "touch /etc/cloud/cloud-init.disabled"
   - "systemctl disable apt-daily.service"
   - "systemctl disable apt-daily.timer"
   - "poweroff"
 """
 
-def download_if_missing(path, url):
-    if not path.is_file():
-        echo_run(['wget', url, '-O', str(path), '-q'])
+class DownloadCache:
+    """
+    Content-addressed cache for upstream files. Downloads are stored as
+    `sha256/<digest>`; `urls/` remembers which digest each URL resolved to,
+    along with its ETag and Last-Modified, so that later fetches only
+    re-download if upstream has changed. Interrupted downloads are kept in
+    `partial/` and resumed with a range request.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for name in ['sha256', 'urls', 'partial']:
+            (self.root / name).mkdir(parents=True, exist_ok=True)
+
+    def key(self, url):
+        return hashlib.sha256(url.encode('utf8')).hexdigest()
+
+    def blob_path(self, digest):
+        return self.root / 'sha256' / digest
+
+    def url_path(self, url):
+        return self.root / 'urls' / (self.key(url) + '.json')
+
+    def partial_path(self, url):
+        return self.root / 'partial' / (self.key(url) + '.part')
+
+    @contextmanager
+    def lock(self, url):
+        lock_path = self.root / 'partial' / (self.key(url) + '.lock')
+        with lock_path.open('w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def fetch(self, url, sha256=None):
+        """
+        Return the path of a cached, up-to-date copy of `url`. If `sha256` is
+        given, the content must match it.
+        """
+        with self.lock(url):
+            return self.fetch_locked(url, sha256)
+
+    def fetch_locked(self, url, sha256):
+        meta = load_json(self.url_path(url))
+        cached = self.blob_path(meta['sha256']) if meta else None
+        if cached is not None and not cached.is_file():
+            cached = None
+        if cached is not None and sha256 and meta['sha256'] != sha256:
+            # upstream published a new checksum, our copy is stale
+            cached = None
+
+        part = self.partial_path(url)
+        part_meta_path = part.with_suffix('.json')
+        headers = {}
+        offset = 0
+
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        elif part.is_file():
+            part_meta = load_json(part_meta_path) or {}
+            validator = part_meta.get('etag') or part_meta.get('last_modified')
+            if validator:
+                offset = part.stat().st_size
+                headers['Range'] = 'bytes={}-'.format(offset)
+                headers['If-Range'] = validator
+
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
+
+        except HTTPError as e:
+            if e.code == 304 and cached is not None:
+                logger.debug("Not modified: %s", url)
+                return cached
+            if e.code == 416 and offset:
+                # the partial file is no prefix of what the server has now
+                logger.info("Can't resume %s, downloading it again", url)
+                part.unlink()
+                if part_meta_path.exists():
+                    part_meta_path.unlink()
+                return self.fetch_locked(url, sha256)
+            raise
+
+        except URLError as e:
+            if cached is not None:
+                logger.warning("Can't check %s (%s), using cached copy",
+                               url, e.reason)
+                return cached
+            raise
+
+        with response:
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            if response.status == 206:
+                logger.info("Resuming %s at %d bytes", url, offset)
+            else:
+                offset = 0
+            save_json(part_meta_path, validators)
+
+            digest = hashlib.sha256()
+            if offset:
+                with part.open('rb') as f:
+                    copy_stream(f, HashingWriter(digest))
+
+            logger.info("Downloading %s", url)
+            t0 = time()
+            with part.open('ab' if offset else 'wb') as f:
+                received = copy_stream(response, HashingWriter(digest, f))
+
+            length = response.headers.get('Content-Length')
+            if length is not None and received != int(length):
+                raise RuntimeError("Download of {} is incomplete, it will "
+                                   "resume next time".format(url))
+
+        size = part.stat().st_size
+        log_throughput("Downloaded", received, received, time() - t0)
+
+        hexdigest = digest.hexdigest()
+        if sha256 and hexdigest != sha256:
+            part.unlink()
+            part_meta_path.unlink()
+            raise RuntimeError("Checksum mismatch for {}: expected {}, got {}"
+                               .format(url, sha256, hexdigest))
+
+        blob = self.blob_path(hexdigest)
+        part.rename(blob)
+        part_meta_path.unlink()
+        save_json(self.url_path(url), dict(
+            validators,
+            url=url,
+            sha256=hexdigest,
+            size=size,
+        ))
+        return blob
+
+    def upstream_sha256(self, url):
+        """ Look up the checksum of `url` in the `SHA256SUMS` next to it. """
+        (base, name) = url.rsplit('/', 1)
+        try:
+            sums = self.fetch(base + '/SHA256SUMS')
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+        with sums.open(encoding='latin1') as f:
+            for line in f:
+                bits = line.split()
+                if len(bits) == 2 and bits[1].lstrip('*') == name:
+                    return bits[0]
+
+        return None
+
 
 class BaseBuilder:
 
     def __init__(self, db_root, workbench, flavor):
         self.workbench = workbench
         self.flavor = flavor
-        self.db = db_root / 'downloads'
-        self.db.mkdir(exist_ok=True)
+        self.downloads = DownloadCache(db_root / 'downloads')
         self.disk = self.workbench / 'disk.img'
-        upstream_image_name = self.get_upstream_image_url().rsplit('/', 1)[-1]
-        self.upstream_image = self.db / upstream_image_name
+
+    def fetch_upstream_image(self):
+        url = self.get_upstream_image_url()
+        return self.downloads.fetch(url, self.downloads.upstream_sha256(url))
 
     def download(self):
-        download_if_missing(self.upstream_image, self.get_upstream_image_url())
+        self.upstream_image = self.fetch_upstream_image()
 
     def unpack_upstream(self):
-        shutil.copy(str(self.upstream_image), str(self.disk))
+        shutil.copyfile(str(self.upstream_image), str(self.disk))
         echo_run(['qemu-img', 'resize', str(self.disk), '10G'])
 
     def create_cloud_init_image(self):
@@ -624,11 +4711,15 @@ class BaseBuilder:
         self.cloud_init_yml.unlink()
 
     def build(self):
-        self.download()
-        self.unpack_upstream()
-        self.create_cloud_init_image()
-        self.run_qemu()
-        self.cleanup()
+        for stage in [
+            self.download,
+            self.unpack_upstream,
+            self.create_cloud_init_image,
+            self.run_qemu,
+            self.cleanup,
+        ]:
+            with tracer.phase('build.' + stage.__name__):
+                stage()
 
 
 class Builder_x86_64(BaseBuilder):
@@ -650,7 +4741,7 @@ class Builder_x86_64(BaseBuilder):
     def run_qemu(self):
         echo_run([
             'qemu-system-x86_64',
-            '-enable-kvm',
+        ] + accel_args() + [
             '-nographic',
             '-m', '512',
             '-netdev', 'user,id=user',
@@ -687,14 +4778,15 @@ class Builder_arm64(BaseBuilder):
         self.arm_bios_fd = self.workbench / 'arm-bios.fd'
 
     def download(self):
-        download_if_missing(self.arm_bios_fd, self.bios_url)
-        super().download()
+        with ThreadPoolExecutor(2) as executor:
+            bios = executor.submit(self.downloads.fetch, self.bios_url)
+            super().download()
+            shutil.copyfile(str(bios.result()), str(self.arm_bios_fd))
 
     def run_qemu(self):
         echo_run([
             'qemu-system-aarch64',
-            '-cpu', 'host',
-            '-enable-kvm',
+        ] + accel_args() + [
             '-nographic',
             '-m', '512',
             '-machine', 'virt',
@@ -735,16 +4827,30 @@ def prepare_cloud_image(*args):
         shutil.rmtree(str(workbench))
         raise
 
+    store_image_files(workbench)
+
+
 COMMANDS = {
     'run': run_factory,
+    'run-many': run_many,
+    'bench': bench,
+    'bench-shares': bench_shares,
     'login': login,
     'console': console,
+    'pool': pool,
+    'daemon': daemon,
+    'jobs': jobs,
+    'snapshot': snapshot,
     'prepare-cloud-image': prepare_cloud_image,
     'create': create_image,
     'export': export_image,
     'import': import_image,
     'fork': fork_image,
+    'compact': compact_image,
+    'build': build_image,
     'rm': remove_image,
+    'du': disk_usage,
+    'gc': collect_garbage,
 }
 
 DEFAULTS = {
@@ -779,12 +4885,24 @@ def main(argv):
     parser = ArgumentParser()
     parser.add_argument('-q', '--quiet', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--trace', help="write phase timings to this file")
     parser.add_argument('command', choices=COMMANDS.keys())
     (options, args) = parser.parse_known_args(argv)
     set_up_logging(options.quiet, options.verbose)
-    COMMANDS[options.command](*args)
+    if options.trace:
+        tracer.open(options.trace)
+    try:
+        with tracer.phase(options.command):
+            COMMANDS[options.command](*args)
+    finally:
+        tracer.finish()
 
 
 def cmd():
     handle_sigterm()
     main(sys.argv[1:])
+
+
+def daemon_cmd():
+    handle_sigterm()
+    main(['daemon'] + sys.argv[1:])
@@ -39,7 +39,7 @@ def main():
     sh('git clone {github} {repo}'.format(**vars))
     os.chdir(vars['repo'])
     sh('wget --progress=dot:giga {image} -O tmp.factory.gz'.format(**vars))
-    sh('zcat tmp.factory.gz | ./factory import cloud')
+    sh('./factory import cloud < tmp.factory.gz')
     sh('rm tmp.factory.gz')
 
 
@@ -8,5 +8,8 @@ setup(
     platforms='any',
     modules=['factory'],
     zip_safe=False,
-    entry_points={'console_scripts': ['factory = factory:cmd']},
+    entry_points={'console_scripts': [
+        'factory = factory:cmd',
+        'factoryd = factory:daemon_cmd',
+    ]},
 )
@@ -0,0 +1,123 @@
+import io
+import sys
+import json
+import shutil
+import subprocess
+from argparse import Namespace
+from pathlib import Path
+import pytest
+from conftest import tmpdir_factory, monkeypatcher, factory_module
+
+
+@pytest.fixture
+def fake_bench():
+    """
+    Run `factory bench --fake-qemu` with extra arguments on an empty image,
+    and return its report.
+    """
+    if shutil.which('qemu-img') is None:
+        pytest.skip("qemu-img is not installed")
+
+    with tmpdir_factory() as factory:
+        (factory.images / 'cloud').mkdir()
+        subprocess.run([
+            'qemu-img', 'create', '-q',
+            '-f', 'qcow2',
+            str(factory.images / 'cloud' / 'disk.img'),
+            '1G',
+        ], check=True)
+
+        def bench(*args, trace=None):
+            output = io.StringIO()
+            with monkeypatcher() as mocks:
+                mocks.setattr(sys, 'stdout', output)
+                factory.main(
+                    (['--trace', str(trace)] if trace else [])
+                    + ['bench', '--fake-qemu'] + list(args)
+                )
+            return json.loads(output.getvalue())
+
+        bench.tmp = factory.images.parent
+        yield bench
+
+
+def test_bench_fake_qemu(fake_bench):
+    report = fake_bench('--repeat', '3')
+    assert report['fake_qemu']
+    for name in ['overlay_seconds', 'qemu_sockets_seconds',
+                 'qmp_command_seconds', 'shutdown_seconds', 'rss_mib']:
+        assert report['results'][name]['count'] == 3
+
+
+def test_trace(fake_bench):
+    trace = fake_bench.tmp / 'run.trace'
+    fake_bench('--repeat', '1', trace=trace)
+
+    lines = trace.read_text().splitlines()
+    assert lines[0] == '['
+    events = [json.loads(line.rstrip(',')) for line in lines[1:]]
+
+    names = [e['name'] for e in events]
+    for name in ['vm.setup_var', 'vm.create_overlay', 'vm.qemu_sockets',
+                 'vm.shutdown', 'vm.teardown', 'bench']:
+        assert name in names
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+
+
+def record_affinity(mocks):
+    calls = []
+    mocks.setattr(factory_module.os, 'sched_setaffinity',
+                  lambda pid, cpus: calls.append((pid, set(cpus))))
+    return calls
+
+
+def test_pin_cpus(fake_bench):
+    with monkeypatcher() as mocks:
+        calls = record_affinity(mocks)
+        fake_bench('--repeat', '1', '--pin-cpus')
+
+    # the fake qemu reports its own pid as the thread of vCPU 0
+    [(pid, cpus)] = calls
+    assert len(cpus) == 1
+    assert cpus <= factory_module.os.sched_getaffinity(0)
+
+
+def test_numa_node(fake_bench):
+    if not Path('/sys/devices/system/node/node0').is_dir():
+        pytest.skip("no NUMA information")
+
+    with monkeypatcher() as mocks:
+        calls = record_affinity(mocks)
+        fake_bench('--repeat', '1', '--numa-node', '0')
+
+    node_cpus = set(factory_module.numa_node_cpus(0))
+    assert calls
+    assert all(cpus == node_cpus for (pid, cpus) in calls)
+
+
+def test_compare_io_profiles(fake_bench):
+    report = fake_bench('--repeat', '1', '--compare-io-profiles')
+    assert sorted(report['io_profiles']) == ['default', 'durable', 'ephemeral']
+
+
+def test_tcg_fallback(fake_bench):
+    with monkeypatcher() as mocks:
+        mocks.setattr(factory_module, 'accelerator', lambda: 'tcg')
+        assert '-enable-kvm' not in factory_module.accel_args()
+        assert factory_module.scale_timeout(60) > 60
+        report = fake_bench('--repeat', '1')
+
+    assert report['accel'] == 'tcg'
+
+
+def test_persist_io_profile():
+    vm = factory_module.VM.__new__(factory_module.VM)
+    vm.config = {'io-profile': 'ephemeral', 'io-settings': {'cache': 'unsafe'}}
+    with monkeypatcher() as mocks:
+        mocks.setattr(factory_module, 'qemu_supports_io_uring', lambda: True)
+
+        vm.options = Namespace(io_profile=None, persist=True)
+        assert vm.io_settings() == factory_module.IO_PROFILES['durable']
+
+        vm.options.persist = False
+        assert vm.io_settings()['cache'] == 'unsafe'
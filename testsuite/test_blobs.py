@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import threading
+from conftest import tmpdir_factory, monkeypatcher, factory_module
+
+
+def make_image(images, name, content):
+    (images / name).mkdir()
+    (images / name / 'disk.img').write_bytes(content)
+    (images / name / 'config.json').write_text('{}')
+    factory_module.store_image_files(images / name)
+
+
+def test_images_share_blobs():
+    shared = os.urandom(1 << 20) * 2
+    with tmpdir_factory() as factory:
+        make_image(factory.images, 'one', shared)
+        make_image(factory.images, 'two', shared)
+        make_image(factory.images, 'three', os.urandom(1 << 20))
+        store = factory_module.BlobStore(factory_module.paths.BLOBS)
+        assert len(store.blobs()) == 2
+        assert (factory.images / 'two' / 'disk.img').read_bytes() == shared
+        assert sorted(os.listdir(str(factory.images / 'one'))) == \
+            ['blobs.json', 'config.json', 'disk.img']
+        assert 'disk.img' in factory_module.image_blobs(factory.images / 'one')
+        assert 'config.json' not in \
+            factory_module.image_blobs(factory.images / 'one')
+
+        output = io.StringIO()
+        with monkeypatcher() as mocks:
+            mocks.setattr(sys, 'stdout', output)
+            factory.main(['du'])
+        rows = {
+            line.split()[0]: line.split()[1:]
+            for line in output.getvalue().splitlines()[1:-1]
+        }
+        assert float(rows['one'][1]) >= 2
+        assert float(rows['three'][1]) == 0
+
+        # a changed disk no longer uses its blob
+        disk = factory.images / 'two' / 'disk.img'
+        factory_module.unshare_blob(disk)
+        with disk.open('r+b') as f:
+            f.write(b'changed')
+        assert factory_module.image_blobs(factory.images / 'two') == {}
+        assert (factory.images / 'one' / 'disk.img').read_bytes() == shared
+
+        factory.main(['rm', 'three'])
+        assert len(store.blobs()) == 1
+        factory.main(['rm', 'one'])
+        assert store.blobs() == []
+
+
+def test_gc_waits_for_images_being_stored():
+    with tmpdir_factory() as factory:
+        store = factory_module.BlobStore(factory_module.paths.BLOBS)
+        staging = factory.images / '.import-test'
+        staging.mkdir()
+        (staging / 'disk.img').write_bytes(os.urandom(1 << 20))
+
+        with store.in_use():
+            factory_module.store_image_files(staging)
+            gc = threading.Thread(target=store.gc)
+            gc.start()
+            gc.join(.2)
+            assert gc.is_alive()
+            staging.rename(factory.images / 'imported')
+        gc.join()
+        assert len(store.blobs()) == 1
+
+
+def test_unshare_read_only_file():
+    with tmpdir_factory() as factory:
+        disk = factory.images / 'disk.img'
+        disk.write_bytes(b'disk')
+        disk.chmod(0o444)
+        factory_module.unshare_blob(disk)
+        assert disk.stat().st_mode & 0o200
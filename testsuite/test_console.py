@@ -0,0 +1,65 @@
+import os
+import socket
+from time import time, sleep
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from conftest import tmpdir_factory, factory_module
+
+
+def wait_for(condition, timeout=5):
+    t0 = time()
+    while not condition():
+        assert time() < t0 + timeout
+        sleep(.01)
+
+
+def test_console_log():
+    with TemporaryDirectory() as tmp:
+        (guest, host) = socket.socketpair()
+        path = Path(tmp) / 'console.log'
+        log = factory_module.ConsoleLog(path, host, max_size=1000)
+        received = []
+        log.listeners.append(received.append)
+        factory_module.console_reader.register(log)
+
+        try:
+            for n in range(100):
+                guest.sendall('line {:02d}\n'.format(n).encode('latin1'))
+            wait_for(lambda: b''.join(received).endswith(b'line 99\n'))
+
+            assert path.stat().st_size <= 500
+            assert path.with_name('console.log.1').stat().st_size <= 500
+            tail = log.tail(100)
+            assert len(tail) == 100
+            assert tail.endswith(b'line 98\nline 99\n')
+
+            log.send(b'root\n')
+            assert guest.recv(100) == b'root\n'
+
+        finally:
+            log.close()
+            guest.close()
+
+
+def test_failed_boot_logs_are_pruned():
+    class FakeConsoleLog:
+        def tail(self):
+            return b'kernel panic\n'
+
+    with tmpdir_factory():
+        var = factory_module.paths.VAR
+        var.mkdir()
+        for n in range(factory_module.FAILED_BOOT_LOGS):
+            log = var / 'failed-boot-{}-vm-old{}.log'.format(n, n)
+            log.write_bytes(b'old')
+            os.utime(str(log), (n, n))
+
+        vm = factory_module.VM.__new__(factory_module.VM)
+        vm.console_log = FakeConsoleLog()
+        vm.var = var / 'vm-new'
+        vm.save_console_tail()
+
+        logs = list(var.glob('failed-boot-*.log'))
+        assert len(logs) == factory_module.FAILED_BOOT_LOGS
+        assert not (var / 'failed-boot-0-vm-old0.log').exists()
+        assert any(log.read_bytes() == b'kernel panic\n' for log in logs)
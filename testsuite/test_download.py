@@ -0,0 +1,142 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import pytest
+from conftest import factory_module
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+
+        etag = '"{}"'.format(hashlib.sha256(content).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') == etag:
+            offset = int(byte_range.split('=')[1].rstrip('-'))
+            if offset >= len(content):
+                self.send_error(416)
+                return
+            content = content[offset:]
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@contextmanager
+def http_server(files):
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.files = files
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def sha256sums(files):
+    return ''.join(
+        '{} *{}\n'.format(hashlib.sha256(content).hexdigest(), name)
+        for name, content in files.items()
+    ).encode('latin1')
+
+
+@pytest.fixture
+def cache():
+    with TemporaryDirectory() as tmp:
+        yield factory_module.DownloadCache(Path(tmp))
+
+
+def test_fetch_and_revalidate(cache):
+    image = b'disk image ' * 1000
+    files = {
+        '/current/disk.img': image,
+        '/current/SHA256SUMS': sha256sums({'disk.img': image}),
+    }
+
+    with http_server(files) as server:
+        url = 'http://127.0.0.1:{}/current/disk.img'.format(server.server_port)
+        blob = cache.fetch(url, cache.upstream_sha256(url))
+        assert blob.read_bytes() == image
+
+        del server.requests[:]
+        assert cache.fetch(url) == blob
+        [(_, headers)] = server.requests
+        assert 'If-None-Match' in headers
+
+        new_image = b'refreshed image ' * 1000
+        files['/current/disk.img'] = new_image
+        files['/current/SHA256SUMS'] = sha256sums({'disk.img': new_image})
+        new_blob = cache.fetch(url, cache.upstream_sha256(url))
+        assert new_blob.read_bytes() == new_image
+        assert new_blob != blob
+
+
+def test_resume(cache):
+    image = bytes(range(256)) * 1000
+    files = {'/disk.img': image}
+    etag = '"{}"'.format(hashlib.sha256(image).hexdigest()[:16])
+
+    with http_server(files) as server:
+        url = 'http://127.0.0.1:{}/disk.img'.format(server.server_port)
+        part = cache.partial_path(url)
+        part.write_bytes(image[:1000])
+        factory_module.save_json(part.with_suffix('.json'), {'etag': etag})
+
+        blob = cache.fetch(url, hashlib.sha256(image).hexdigest())
+        assert blob.read_bytes() == image
+        [(_, headers)] = server.requests
+        assert headers['Range'] == 'bytes=1000-'
+        assert not part.exists()
+
+
+def test_resume_past_the_end(cache):
+    image = b'short image'
+    files = {'/disk.img': image}
+    etag = '"{}"'.format(hashlib.sha256(image).hexdigest()[:16])
+
+    with http_server(files) as server:
+        url = 'http://127.0.0.1:{}/disk.img'.format(server.server_port)
+        part = cache.partial_path(url)
+        part.write_bytes(b'a much longer partial download')
+        factory_module.save_json(part.with_suffix('.json'), {'etag': etag})
+
+        blob = cache.fetch(url, hashlib.sha256(image).hexdigest())
+        assert blob.read_bytes() == image
+        [(_, first), (_, second)] = server.requests
+        assert 'Range' in first
+        assert 'Range' not in second
+
+
+def test_checksum_mismatch(cache):
+    files = {'/disk.img': b'corrupted'}
+
+    with http_server(files) as server:
+        url = 'http://127.0.0.1:{}/disk.img'.format(server.server_port)
+        with pytest.raises(RuntimeError):
+            cache.fetch(url, hashlib.sha256(b'original').hexdigest())
+        assert not list((cache.root / 'sha256').iterdir())
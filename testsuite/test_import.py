@@ -0,0 +1,41 @@
+import io
+import sys
+import subprocess
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import pytest
+from conftest import tmpdir_factory, monkeypatcher, factory_module
+
+
+def archive(files, members):
+    """ A tar archive in the layout `export` writes, with only `members`. """
+    with TemporaryDirectory() as tmp:
+        staging = Path(tmp)
+        for (name, content) in files.items():
+            (staging / name).write_bytes(content)
+        factory_module.write_manifest(staging)
+        return subprocess.check_output(
+            ['tar', 'c', '-C', str(staging)] + members,
+        )
+
+
+def import_bytes(factory, name, data):
+    with monkeypatcher() as mocks:
+        mocks.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(data)))
+        factory.main(['import', name])
+
+
+def test_import():
+    files = {'disk.img': b'disk' * 1000, 'config.json': b'{}'}
+    manifest = factory_module.MANIFEST_NAME
+    with tmpdir_factory() as factory:
+        import_bytes(factory, 'whole',
+                     archive(files, [manifest, 'config.json', 'disk.img']))
+        assert (factory.images / 'whole' / 'disk.img').read_bytes() == \
+            files['disk.img']
+
+        # cut off at a member boundary, which tar doesn't complain about
+        truncated = archive(files, [manifest, 'config.json'])
+        with pytest.raises(RuntimeError):
+            import_bytes(factory, 'truncated', truncated)
+        assert not (factory.images / 'truncated').exists()
@@ -0,0 +1,63 @@
+import os
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from conftest import tmpdir_factory, monkeypatcher, factory_module
+
+
+def add_layer(cache, key, parent, size, last_used):
+    cache.path(key).mkdir()
+    factory_module.save_json(cache.path(key) / 'layer.json', {
+        'parent': parent,
+        'step': {'run': key},
+        'size': size,
+        'created': last_used,
+        'last_used': last_used,
+    })
+
+
+def test_evict():
+    with tmpdir_factory():
+        cache = factory_module.LayerCache(factory_module.paths.LAYERS)
+        now = factory_module.time()
+        add_layer(cache, 'a', 'base:x', 100, now - 50)
+        add_layer(cache, 'b', 'a', 100, now - 40)
+        add_layer(cache, 'c', 'a', 100, now - 10)
+        add_layer(cache, 'old', 'base:x', 100, now - 1000)
+
+        assert cache.evict(max_size=1000, max_age=500) == ['old']
+        # `a` is a parent, so it goes only after its children
+        assert cache.evict(max_size=150, max_age=500) == ['b', 'c']
+        assert sorted(cache.layers()) == ['a']
+
+        with cache.in_use():
+            assert cache.evict(max_size=0, max_age=0) == []
+
+
+def test_unreadable_image_keeps_layers():
+    def backing_chain(disk):
+        raise factory_module.subprocess.CalledProcessError(1, 'qemu-img')
+
+    with tmpdir_factory() as factory, monkeypatcher() as mocks:
+        mocks.setattr(factory_module, 'backing_chain', backing_chain)
+        cache = factory_module.LayerCache(factory_module.paths.LAYERS)
+        add_layer(cache, 'a', 'base:x', 100, 0)
+        (factory.images / 'broken').mkdir()
+        (factory.images / 'broken' / 'disk.img').write_bytes(b'')
+
+        assert cache.evict(max_size=0, max_age=0) == []
+        assert factory_module.image_dependents(
+            factory.images / 'other' / 'disk.img') == []
+
+
+def test_tree_sha256():
+    with TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / 'sub').mkdir()
+        (root / 'sub' / 'file').write_text('hello')
+        before = factory_module.tree_sha256(root)
+
+        os.utime(str(root / 'sub' / 'file'), (0, 0))
+        assert factory_module.tree_sha256(root) == before
+
+        (root / 'sub' / 'file').chmod(0o755)
+        assert factory_module.tree_sha256(root) != before
@@ -0,0 +1,87 @@
+import os
+import subprocess
+from tempfile import TemporaryDirectory
+from argparse import Namespace
+from pathlib import Path
+import pytest
+from conftest import factory_module, monkeypatcher
+
+
+@pytest.fixture
+def broker():
+    with TemporaryDirectory() as tmp:
+        yield factory_module.ResourceBroker(Path(tmp))
+
+
+def test_leases_are_disjoint(broker):
+    cpus = len(os.sched_getaffinity(0))
+    with broker.lease(memory=1, cpus=cpus, ports=2) as first:
+        with broker.lease(memory=1, cpus=1, ports=2) as second:
+            ports = first['ports'] + second['ports']
+            assert len(set(ports)) == 4
+            assert all(factory_module.port_is_free(p) for p in ports)
+            assert len(first['cpus']) == cpus
+            assert second['cpus'] == []
+
+        with broker.state() as state:
+            assert len(state['leases']) == 1
+
+    with broker.state() as state:
+        assert state['leases'] == {}
+
+
+def test_dead_process_leases_are_dropped(broker):
+    child = subprocess.Popen(['true'])
+    child.wait()
+    with broker.state() as state:
+        state['leases']['dead'] = {
+            'pid': child.pid,
+            'start_time': 0,
+            'memory': 1,
+            'ports': [2000],
+            'cpus': [0],
+        }
+
+    with broker.state() as state:
+        assert state['leases'] == {}
+
+
+def test_memory_is_committed(broker):
+    with monkeypatcher() as mocks:
+        mocks.setattr(broker, 'memory_limit', lambda: 1000)
+
+        with pytest.raises(RuntimeError):
+            with broker.lease(memory=2000, cpus=1):
+                pass
+
+        with broker.lease(memory=600, cpus=1, ports=0):
+            with pytest.raises(RuntimeError):
+                with broker.lease(memory=600, cpus=1, ports=0, timeout=0):
+                    pass
+            with broker.lease(memory=400, cpus=1, ports=0):
+                pass
+
+
+def test_ram_overlay_reservation():
+    with TemporaryDirectory() as tmp, monkeypatcher() as mocks:
+        root = Path(tmp) / 'shm'
+        root.mkdir()
+        mocks.setattr(factory_module, 'RAM_OVERLAY_ROOT', root)
+        mocks.setattr(factory_module.paths, 'VAR', Path(tmp) / 'var')
+        mocks.setattr(factory_module, 'disk_virtual_size',
+                      lambda disk: 1 << 20)
+
+        vm = factory_module.VM.__new__(factory_module.VM)
+        vm.config = {}
+        vm.use_ssh = True
+        vm.disk = Path(tmp) / 'disk.img'
+        vm.options = Namespace(
+            ram_overlay=True, ram_overlay_size='1M', swap='1M', persist=False)
+
+        # the disk and the swap can outgrow the cap
+        vm.setup_ram_overlay()
+        assert vm.ram_overlay is None
+
+        vm.options.ram_overlay_size = '3M'
+        vm.setup_ram_overlay()
+        assert int((vm.ram_overlay / 'reserved').read_text()) >= 2 << 20
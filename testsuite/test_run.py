@@ -1,7 +1,11 @@
 from time import time, sleep
+import sys
+import io
+import json
 import subprocess
 import random
-from contextlib import closing
+from contextlib import closing, contextmanager
+import pytest
 from urllib.request import urlopen
 from conftest import thread, monkeypatcher
 
@@ -159,3 +163,198 @@ def test_persist(factory):
     factory.main(['run', '--image', 'elephant', 'ls'])
     output = factory.ssh_result.stdout.decode('latin1')
     assert output.strip() == 'trunk'
+
+
+def test_run_many(factory, shared):
+    jobs = [
+        {
+            'name': 'touch-{}'.format(n),
+            'share': ['{}:/mnt/shared'.format(shared)],
+            'command': ['touch', '/mnt/shared/{}.txt'.format(n)],
+        }
+        for n in range(2)
+    ]
+    jobs.append({'name': 'fail', 'command': 'echo nope; false'})
+    jobs_json = shared / 'jobs.json'
+    with jobs_json.open('w', encoding='utf8') as f:
+        json.dump(jobs, f)
+
+    try:
+        factory.main(['run-many', str(jobs_json), '-o', str(shared / 'out'),
+                      '--report', str(shared / 'report.json')])
+    except RuntimeError as e:
+        assert '1 of 3 jobs failed' in str(e)
+    else:
+        raise AssertionError('run-many should have failed')
+
+    assert (shared / '0.txt').is_file()
+    assert (shared / '1.txt').is_file()
+    with (shared / 'report.json').open(encoding='utf8') as f:
+        report = json.load(f)
+    exit_codes = {job['name']: job['exit_code'] for job in report['jobs']}
+    assert exit_codes == {'touch-0': 0, 'touch-1': 0, 'fail': 1}
+    assert (shared / 'out' / 'fail.log').read_text().strip() == 'nope'
+
+
+@contextmanager
+def redirect(name, f):
+    wrapper = io.TextIOWrapper(f)
+    with monkeypatcher() as mocks:
+        mocks.setattr(sys, name, wrapper)
+        yield
+    wrapper.detach()
+
+
+def test_export_import(factory, shared):
+    dump = shared / 'cloud.factory.gz'
+    with dump.open('wb') as f, redirect('stdout', f):
+        factory.main(['export', 'cloud', '--compress', 'gzip'])
+
+    with dump.open('rb') as f, redirect('stdin', f):
+        factory.main(['import', 'restored'])
+    factory.main(['run', '--image', 'restored', 'true'])
+
+    truncated = shared / 'truncated.factory.gz'
+    with dump.open('rb') as f:
+        truncated.write_bytes(f.read(dump.stat().st_size // 2))
+    with truncated.open('rb') as f, redirect('stdin', f):
+        with pytest.raises(RuntimeError):
+            factory.main(['import', 'broken'])
+    assert not (factory.images / 'broken').exists()
+
+
+def test_export_relative(factory, shared):
+    factory.main(['fork', 'cloud', 'kitten'])
+    factory.main(['run', '--image', 'kitten', '--persist', 'touch', '/opt/paw'])
+
+    dump = shared / 'kitten.factory'
+    with dump.open('wb') as f, redirect('stdout', f):
+        factory.main(['export', 'kitten', '--relative-to', 'cloud'])
+    assert dump.stat().st_size < 100 << 20
+
+    with dump.open('rb') as f, redirect('stdin', f):
+        factory.main(['import', 'kitten-copy'])
+    factory.main(['run', '--image', 'kitten-copy', 'test', '-f', '/opt/paw'])
+    # files that the base image has weren't exported, they're linked
+    for file in (factory.images / 'kitten-copy').iterdir():
+        assert file.name in ['disk.img', 'blobs.json'] or file.is_symlink()
+
+    with dump.open('rb') as f, redirect('stdin', f):
+        with pytest.raises(RuntimeError):
+            factory.main(['import', 'mismatched', '--base', 'kitten'])
+    assert not (factory.images / 'mismatched').exists()
+
+
+def test_snapshot(factory):
+    factory.main(['fork', 'cloud', 'sloth'])
+    factory.main(['snapshot', '--image', 'sloth'])
+    image = factory.images / 'sloth'
+    assert (image / 'snapshot.json').is_file()
+
+    factory.main(['run', '--image', 'sloth', 'echo', 'awake'])
+    assert factory.ssh_result.stdout.strip() == b'awake'
+
+    factory.main(['run', '--image', 'sloth', '--persist', 'true'])
+    assert not (image / 'snapshot.json').exists()
+
+
+def test_pool(factory):
+    import factory as factory_module  # noqa
+
+    paths = factory_module.paths
+    paths.VAR.mkdir(exist_ok=True)
+    pool = factory_module.VMPool([], {'cloud': 1})
+
+    with thread(lambda: pool.serve(paths.SOCKET)):
+        try:
+            t0 = time()
+            timeout = 180
+
+            while time() < t0 + timeout:
+                if pool.ready['cloud']:
+                    break
+                sleep(.5)
+
+            else:
+                raise RuntimeError('pool not ready after %d seconds' % timeout)
+
+            leased_var = str(pool.ready['cloud'][0].vm.var)
+            factory.main(['run', 'true'])
+            assert leased_var in ' '.join(factory.ssh_result.args)
+
+        finally:
+            pool.stopping.set()
+
+
+def test_daemon(factory, shared):
+    import factory as factory_module  # noqa
+
+    paths = factory_module.paths
+    paths.VAR.mkdir(exist_ok=True)
+    daemon = factory_module.Daemon([], {})
+
+    with thread(lambda: daemon.serve(paths.SOCKET)):
+        try:
+            while not paths.SOCKET.exists():
+                sleep(.1)
+
+            output = shared / 'output'
+            with output.open('wb') as f, redirect('stdout', f):
+                factory.main(['run', 'echo', 'hello'])
+            assert output.read_bytes() == b'hello\n'
+
+            with pytest.raises(subprocess.CalledProcessError):
+                factory.main(['run', 'false'])
+
+            with shared.joinpath('list').open('wb') as f, \
+                    redirect('stdout', f):
+                factory.main(['jobs'])
+            listing = json.loads(shared.joinpath('list').read_text())
+            states = [job['state'] for job in listing['jobs']]
+            assert states == ['finished', 'finished']
+
+        finally:
+            daemon.stopping.set()
+
+
+def test_inject_collect(factory, shared):
+    source = shared / 'source'
+    (source / 'sub').mkdir(parents=True)
+    write(source / 'sub' / 'input.txt', 'hello\n', 0o644)
+
+    factory.main([
+        'run',
+        '--inject', '{}:/opt/work'.format(source),
+        '--collect', '/opt/work:{}'.format(shared / 'results'),
+        'sh', '-c', 'tr a-z A-Z < /opt/work/sub/input.txt > /opt/work/out',
+    ])
+    assert (shared / 'results' / 'out').read_text() == 'HELLO\n'
+    assert (shared / 'results' / 'sub' / 'input.txt').is_file()
+
+
+def test_build(factory, shared):
+    (shared / 'app').mkdir()
+    write(shared / 'app' / 'hello.sh', 'echo hello from the app\n')
+    recipe = {
+        'base': 'cloud',
+        'steps': [
+            {'run': 'echo built > /opt/first'},
+            {'copy': 'app:/opt/app'},
+        ],
+    }
+    recipe_json = shared / 'penguin.json'
+    with recipe_json.open('w', encoding='utf8') as f:
+        json.dump(recipe, f)
+
+    factory.main(['build', str(recipe_json)])
+    with factory.images.joinpath('penguin', 'build.json').open() as f:
+        assert [s['cached'] for s in json.load(f)['steps']] == [False, False]
+
+    write(shared / 'app' / 'hello.sh', 'echo hello again\n')
+    factory.main(['build', str(recipe_json)])
+    with factory.images.joinpath('penguin', 'build.json').open() as f:
+        assert [s['cached'] for s in json.load(f)['steps']] == [True, False]
+
+    factory.main(['run', '--image', 'penguin',
+                  'sh', '-c', 'cat /opt/first; sh /opt/app/hello.sh'])
+    assert factory.ssh_result.stdout == b'built\nhello again\n'